@@ -142,15 +142,30 @@ amazing
 
 from __future__ import print_function
 from random import randint
-import urllib2
+from collections import deque, OrderedDict
+from itertools import islice
+import hashlib
 import json
-import ast
+import os
 import string
+import struct
+import sys
+import threading
+import time
+import zlib
+try:
+    intern
+except NameError:
+    from sys import intern
 
 # "web" or "local"
 #elizaType = "web"
 elizaType = "local"
 
+# slim load for the smallest Lambda memory sizes: drop the module docstring and don't create
+# the web Eliza machinery unless it is used (set ELIZA_SLIM=1 in the Lambda environment)
+slimLoad = os.environ.get("ELIZA_SLIM", "") == "1"
+
 # --------------- Helpers that build all the responses ----------------------
 def build_speechlet_response(title, output, reprompt_text, should_end_session, cardOutput=""):
 
@@ -198,15 +213,31 @@ def welcome_response(attributes):
     session_attributes = attributes
     return build_response(session_attributes, build_speechlet_response(card_title, speech_output, reprompt_text, should_end_session))
 
-def handle_session_end_request():
-    responses = ["OK then... Goodbye for now!  ", 
-        "Bye bye, come back soon! ",
-        "That was fun, please talk to me again soon! ",
-        "I will be a bit sad while you are gone so come back soon. Goodbye! ",
-        "Thank you and talk to you later! "]
+# static lines are created (and interned) once and shared by all requests handled by this container
+goodbyeLines = tuple(intern(line) for line in (
+    "OK then... Goodbye for now!  ",
+    "Bye bye, come back soon! ",
+    "That was fun, please talk to me again soon! ",
+    "I will be a bit sad while you are gone so come back soon. Goodbye! ",
+    "Thank you and talk to you later! "))
+
+repromptLines = tuple(intern(line) for line in (
+    "Please say something. ",
+    "Come on, tell me something! ",
+    "Please talk to me! ",
+    "I'm still listening, please say something. ",
+    "I'm still here. Shall we continue our conversation? ",
+    "What's bothering you? ",
+    "Tell me what's bothering you? ",
+    "Hey, you were saying? ",
+    "You were saying? ",
+    "If you don't want to talk to me any more just say goodbye. ",
+    "Do you have anything else to say? ",
+    "You are so quiet. Please say something. "))
 
+def handle_session_end_request():
     card_title = "Goodbye"
-    speech_output = select_random_response(responses)
+    speech_output = select_random_response(goodbyeLines)
     should_end_session = True
     return build_response({}, build_speechlet_response(card_title, speech_output, None, should_end_session))
 
@@ -221,23 +252,11 @@ def handle_help_request(attributes):
     return build_response(session_attributes, build_speechlet_response(card_title, speech_output, reprompt_text, should_end_session))
 
 # this function should be used for all regular messages as it remembers what's been said, allowing the user to interrupt the game with other questions
-def say_message(cardName, message, attributes, cardMessage):
-    repeats = ["Please say something. ", 
-        "Come on, tell me something! ",
-        "Please talk to me! ",
-        "I'm still listening, please say something. ",
-        "I'm still here. Shall we continue our conversation? ",
-        "What's bothering you? ",
-        "Tell me what's bothering you? ",
-        "Hey, you were saying? ",
-        "You were saying? ",
-        "If you don't want to talk to me any more just say goodbye. ",
-        "Do you have anything else to say? ",
-        "You are so quiet. Please say something. "]
-
+# ref is the compact reference of a local Eliza line (see analyze_ref), remembered instead of the full text
+def say_message(cardName, message, attributes, cardMessage, ref=None):
     speech_output = message
-    reprompt_text = select_random_response(repeats)
-    attributes["lastRsp"] = message
+    reprompt_text = select_random_response(repromptLines)
+    attributes["lastRsp"] = message if ref is None else ref
     session_attributes = attributes
     should_end_session = False
     return build_response(session_attributes, build_speechlet_response(cardName, speech_output, reprompt_text, should_end_session, cardMessage))
@@ -245,6 +264,449 @@ def say_message(cardName, message, attributes, cardMessage):
 def select_random_response(responses):
     return responses[randint(0,len(responses) - 1)]
    
+# --------------- Web Eliza (remote server) ----------------------
+webUrl = "https://www.x.y.z.com/eliza"
+# total time (seconds) a turn may wait for the server before answering locally - Alexa needs a reply quickly
+webLatencyBudget = 2.0
+# send a hedged request once a call takes longer than this percentile of recent call latencies
+webHedgePercentile = 0.95
+# hedge delay used until enough latency samples are collected, and its lower bound
+webHedgeDefaultDelay = 0.8
+webHedgeMinDelay = 0.3
+webHedgeMinSamples = 20
+# "local": answer with analyze() straight away when hedging, "request": send a second request to the server.
+# Use "request" only with a server which keeps no state per session - the web Eliza does, so a second copy
+# of the turn would advance its conversation twice and the user could hear the answer of either copy
+webHedgeMode = "local"
+# open the circuit (route everything locally) after this many consecutive failures, probe again after the cooldown
+webBreakerThreshold = 5
+webBreakerCooldown = 30.0
+# idle keep-alive connections kept to the web Eliza, closed instead of reused once idle for webPoolIdleTimeout
+# seconds (servers and load balancers drop idle connections, a warm container may wait much longer)
+webPoolSize = 4
+webPoolIdleTimeout = 30.0
+# concurrent turns of the same session with the same normalized query, locale and previous Eliza line (e.g. a
+# request Alexa retried) share one web call; the server keeps state per session, so sessions never share
+webCoalesce = True
+# let Alexa say a short filler (progressive response) when the web Eliza hasn't answered within progressiveDelay
+# seconds; nothing is said for fast answers or while the circuit is open
+webProgressive = True
+progressiveDelay = 0.5
+progressiveTimeout = 1.0
+progressiveFillers = tuple(intern(line) for line in (
+    "<say-as interpret-as=\"interjection\">uh huh</say-as>",
+    "<say-as interpret-as=\"interjection\">well well</say-as>",
+    "Hmm... ",
+    "Let me think. ",
+    "I see... "))
+
+
+class LatencyTracker(object):
+    """ Keeps a window of recent web call latencies to derive the hedging delay """
+
+    def __init__(self, size=100):
+        self.samples = deque(maxlen=size)
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, fraction):
+        with self.lock:
+            ordered = sorted(self.samples)
+        if not ordered:
+            return None
+        return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+    def hedge_delay(self):
+        if len(self.samples) < webHedgeMinSamples:
+            delay = webHedgeDefaultDelay
+        else:
+            delay = max(self.percentile(webHedgePercentile), webHedgeMinDelay)
+        return min(delay, webLatencyBudget)
+
+
+class CircuitBreaker(object):
+    """ Routes all traffic locally after repeated web failures. Once the cooldown
+    has passed a single probe request is let through; its outcome closes or re-opens the circuit.
+    """
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, threshold, cooldown, clock=time.time):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.clock = clock
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.openedAt = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == CircuitBreaker.CLOSED:
+                return True
+            if self.state == CircuitBreaker.OPEN and self.clock() - self.openedAt >= self.cooldown:
+                # let one probe through, everybody else stays local until it completes
+                self.state = CircuitBreaker.HALF_OPEN
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.state = CircuitBreaker.CLOSED
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+                self.state = CircuitBreaker.OPEN
+                self.openedAt = self.clock()
+
+
+class FlightTimeout(Exception):
+    """ Raised to callers which gave up waiting for a shared call """
+
+
+class Flight(object):
+    __slots__ = ("done", "result", "error", "started")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.started = time.time()
+
+
+class SingleFlight(object):
+    """ Lets concurrent callers with the same key share a single call: the first caller runs it,
+    the others wait (up to their timeout) for its result or exception. A call older than the
+    caller's timeout is not joined any more, so a hung call doesn't block its key forever.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.lock = threading.Lock()
+        # metrics
+        self.executed = 0
+        self.shared = 0
+        self.timeouts = 0
+
+    def do(self, key, fn, timeout=None):
+        with self.lock:
+            flight = self.flights.get(key)
+            leader = flight is None or (timeout is not None and time.time() - flight.started > timeout)
+            if leader:
+                flight = Flight()
+                self.flights[key] = flight
+                self.executed += 1
+            else:
+                self.shared += 1
+
+        if leader:
+            try:
+                flight.result = fn()
+            except Exception as e:
+                flight.error = e
+            finally:
+                with self.lock:
+                    if self.flights.get(key) is flight:
+                        del self.flights[key]
+                flight.done.set()
+        elif not flight.done.wait(timeout):
+            with self.lock:
+                self.timeouts += 1
+            raise FlightTimeout(key)
+
+        if flight.error is not None:
+            raise flight.error
+        return flight.result
+
+    def do_async(self, key, fn, timeout=None, loop=None):
+        """ asyncio flavour of do(), returns an awaitable; waiting happens in the loop's executor """
+        import asyncio
+        loop = loop or asyncio.get_event_loop()
+        return loop.run_in_executor(None, self.do, key, fn, timeout)
+
+    def stats(self):
+        with self.lock:
+            return {"executed": self.executed, "shared": self.shared, "timeouts": self.timeouts,
+                    "inFlight": len(self.flights)}
+
+
+class ConnectionPool(object):
+    """ Keep-alive HTTPS connections to the web Eliza, reused by the turns of a warm container """
+
+    def __init__(self, url, size, idleTimeout, clock=time.time):
+        try:
+            import httplib
+            from urlparse import urlparse
+        except ImportError:
+            import http.client as httplib
+            from urllib.parse import urlparse
+        parsed = urlparse(url)
+        self.httplib = httplib
+        self.host = parsed.netloc
+        self.path = parsed.path or "/"
+        self.size = size
+        self.idleTimeout = idleTimeout
+        self.clock = clock
+        # (connection, time it was released), the most recently used last
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, timeout, fresh=False):
+        """ An idle connection (unless fresh is set) or a new one """
+        stale = []
+        conn = None
+        with self.lock:
+            expired = self.clock() - self.idleTimeout
+            while self.idle and self.idle[0][1] < expired:
+                stale.append(self.idle.pop(0)[0])
+            while self.idle and not fresh and conn is None:
+                conn = self.idle.pop()[0]
+                if dropped(conn):
+                    stale.append(conn)
+                    conn = None
+        for old in stale:
+            old.close()
+        if conn is None:
+            conn = self.httplib.HTTPSConnection(self.host, timeout=timeout)
+        elif conn.sock is not None:
+            conn.sock.settimeout(timeout)
+        return conn
+
+    def release(self, conn):
+        with self.lock:
+            if len(self.idle) < self.size:
+                self.idle.append((conn, self.clock()))
+                return
+        conn.close()
+
+    def prime(self, count, timeout):
+        """ Open (DNS lookup, TCP and TLS handshakes) up to count connections ahead of the first turn """
+        for i in range(count - len(self.idle)):
+            conn = self.acquire(timeout, fresh=True)
+            conn.connect()
+            self.release(conn)
+
+
+# created on first use of the web Eliza, see init_web()
+webLatency = None
+webBreaker = None
+webFlights = None
+webPool = None
+
+
+def init_web():
+    global webLatency, webBreaker, webFlights, webPool
+    if webBreaker is None:
+        webLatency = LatencyTracker()
+        webFlights = SingleFlight()
+        webPool = ConnectionPool(webUrl, webPoolSize, webPoolIdleTimeout)
+        webBreaker = CircuitBreaker(webBreakerThreshold, webBreakerCooldown)
+
+
+def load_urllib():
+    """ The HTTP client is only imported when the web Eliza is used - it is large compared to this skill """
+    try:
+        import urllib2
+    except ImportError:
+        # Python 3 (local tools and tests)
+        import urllib.request as urllib2
+    return urllib2
+
+
+def load_queue():
+    try:
+        import Queue as queue
+    except ImportError:
+        import queue
+    return queue
+
+
+def dropped(conn):
+    """ True if the server closed the idle connection (its socket reads end of file) """
+    import select
+    if conn.sock is None:
+        return False
+    try:
+        return bool(select.select([conn.sock], [], [], 0)[0])
+    except (select.error, ValueError):
+        return True
+
+
+def send_request(conn, data):
+    conn.request("POST", webPool.path, data, {'Content-Type': 'application/json'})
+
+
+def send_failed(e):
+    """ True for errors of a connection which the server closed before the request was sent """
+    import socket
+    return isinstance(e, socket.error) and not isinstance(e, socket.timeout)
+
+
+def post_web_eliza(req, timeout):
+    """ Send a single query to the web Eliza and return the response text """
+    import ast
+    init_web()
+    data = json.dumps(req).encode("utf-8")
+    conn = webPool.acquire(timeout)
+    reused = conn.sock is not None
+    try:
+        send_request(conn, data)
+    except Exception as e:
+        conn.close()
+        # the server may have closed a kept-alive connection just now: send once more on a new one.
+        # Only failures to send are retried - once the request is out, the server (keeping state per
+        # session) may have acted on it, and a second copy would advance the conversation twice
+        if not reused or not send_failed(e):
+            raise
+        conn = webPool.acquire(timeout, fresh=True)
+        try:
+            send_request(conn, data)
+        except Exception:
+            conn.close()
+            raise
+    try:
+        f = conn.getresponse()
+        response = f.read()
+    except Exception:
+        conn.close()
+        raise
+    if f.status >= 400:
+        conn.close()
+        raise IOError("Web Eliza HTTP error %d" % f.status)
+    webPool.release(conn)
+    if not isinstance(response, str):
+        response = response.decode('latin-1')
+    rsp = ast.literal_eval(response)
+
+    #print("JSON req: " + str(req))
+    #print("HTTP rsp: " + str(response))
+    # get the response text out
+    message = rsp["response"]
+    if not isinstance(message, type(u"")):
+        message = message.decode('latin-1')
+    return message
+
+
+def post_directive(apiEndpoint, apiAccessToken, directive, timeout):
+    """ Send a directive to the Alexa Progressive Response API """
+    urllib2 = load_urllib()
+    httpReq = urllib2.Request(apiEndpoint + "/v1/directives",
+                              json.dumps(directive).encode("utf-8"),
+                              {'Content-Type': 'application/json',
+                               'Authorization': 'Bearer ' + apiAccessToken})
+    urllib2.urlopen(httpReq, timeout=timeout).close()
+
+
+# replaceable (e.g. by a local stub in tests): called as directiveSender(apiEndpoint, apiAccessToken, directive, timeout)
+directiveSender = post_directive
+
+
+def send_progressive_response(context, requestId, ssml):
+    """ Start sending a progressive response in the background; the final response is not affected.
+    Returns the sending thread, or None if the request carries no API access (e.g. the simulator).
+    """
+    system = (context or {}).get("System", {})
+    if not system.get("apiAccessToken") or not system.get("apiEndpoint"):
+        return None
+    directive = {"header": {"requestId": requestId},
+                 "directive": {"type": "VoicePlayer.Speak", "speech": "<speak>" + ssml + "</speak>"}}
+
+    def send():
+        try:
+            directiveSender(system["apiEndpoint"], system["apiAccessToken"], directive, progressiveTimeout)
+        except Exception:
+            # best effort only - a missing filler must never break the turn
+            pass
+
+    t = threading.Thread(target=send)
+    t.daemon = True
+    t.start()
+    return t
+
+
+def ask_web_eliza(req, phrase, attributes, post=post_web_eliza, filler=None):
+    """ Get a response from the web Eliza within webLatencyBudget.
+    A slow call is answered locally (or hedged with a second request, see webHedgeMode),
+    and failures, timeouts and an open circuit fall back to the local analyze().
+    filler is called once the server has taken progressiveDelay seconds, if it is still waited for.
+    """
+    init_web()
+    if not webBreaker.allow():
+        return analyze(phrase, attributes)
+
+    timer = None
+    if filler is not None:
+        timer = threading.Timer(progressiveDelay, filler)
+        timer.daemon = True
+        timer.start()
+    try:
+        return wait_web_eliza(req, phrase, attributes, post)
+    finally:
+        if timer is not None:
+            timer.cancel()
+
+
+def wait_web_eliza(req, phrase, attributes, post):
+    queue = load_queue()
+    results = queue.Queue()
+    key = (attributes.get("chatbotSessionId"), normalize_input(phrase), req["attr"]["locale"],
+           repr(attributes.get("lastRsp")))
+
+    def attempt(coalesce):
+        started = time.time()
+        try:
+            if coalesce:
+                message = webFlights.do(key, lambda: post(req, webLatencyBudget), webLatencyBudget)
+            else:
+                message = post(req, webLatencyBudget)
+        except Exception as e:
+            results.put((False, e))
+            return
+        webLatency.add(time.time() - started)
+        results.put((True, message))
+
+    def start_attempt(coalesce):
+        t = threading.Thread(target=attempt, args=(coalesce,))
+        t.daemon = True
+        t.start()
+
+    start = time.time()
+    hedgeAt = start + webLatency.hedge_delay()
+    deadline = start + webLatencyBudget
+    hedged = False
+    pending = 1
+    start_attempt(webCoalesce)
+    while pending:
+        try:
+            ok, value = results.get(timeout=max((deadline if hedged else hedgeAt) - time.time(), 0))
+        except queue.Empty:
+            if hedged or webHedgeMode != "request":
+                # out of time - answer locally
+                break
+            hedged = True
+            pending += 1
+            # the hedge must not join the flight it is hedging
+            start_attempt(False)
+            continue
+        pending -= 1
+        if ok:
+            webBreaker.record_success()
+            return value
+        webBreaker.record_failure()
+    else:
+        # every attempt failed
+        return analyze(phrase, attributes)
+
+    webBreaker.record_failure()
+    return analyze(phrase, attributes)
+
 # ----------------------- Events
 # ---------------------------------------------------
 def on_session_started(session_started_request, session):
@@ -268,7 +730,7 @@ def on_launch(launch_request, session):
     return welcome_response(attributes)
 
 
-def on_intent(intent_request, session):
+def on_intent(intent_request, session, context=None):
     """ Called when the user specifies an intent for this skill """
     #print("on_intent: session: " + str(session))
     #print("           intent_request: " + str(intent_request))
@@ -290,11 +752,14 @@ def on_intent(intent_request, session):
     if intent_name == "TellEliza":
 
         phrase = ""
+        ref = None
+        script = None
         if 'Phrase' in intent['slots'].keys() and 'value' in intent['slots']['Phrase'].keys():
             phrase = intent['slots']['Phrase']['value']
         else:
             # user did not provide any input
             phrase = ""
+        started = time.time()
 
         if (elizaType == "web"):
 			# Call into an external web service to get a response from Eliza running over there
@@ -304,27 +769,21 @@ def on_intent(intent_request, session):
             req["attr"]["timestamp"] = intent_request["timestamp"]
             req["session"]["id"] = attributes["chatbotSessionId"]
             req["request"]["query"] = phrase
- 
-            # send query to server and get response
-            data = json.dumps(req)
-            httpReq = urllib2.Request("https://www.x.y.z.com/eliza", 
-                                data, 
-                                {'Content-Type': 'application/json'})
-            f = urllib2.urlopen(httpReq)
-            response = f.read()
-            rsp = ast.literal_eval(response)
-            f.close()
-
-            #print("JSON req: " + str(req))
-            #print("JSON data: " + str(data))
-            #print("HTTP rsp: " + str(response))
-            # get the response text out
-            message = rsp["response"].decode('latin-1')
-            #print("message: " + message)
+
+            # say a filler if the server takes a while
+            filler = None
+            if webProgressive:
+                filler = lambda: send_progressive_response(context, intent_request["requestId"],
+                                                           select_random_response(progressiveFillers))
+
+            # send query to server and get response (or a local one if the server is slow or down)
+            message = ask_web_eliza(req, phrase, attributes, filler=filler)
 
         else:
 			# Use the local implementation
-            message=analyze(phrase, attributes)
+            script = locale_script(intent_request.get("locale"))
+            message, ref = analyze_ref(phrase, attributes, script)
+        record_turn(attributes, phrase, ref, started, intent_request.get("locale", ""), script)
 
         cardText = "You: " + phrase + "\n" + \
                    "Eliza: " + message
@@ -333,7 +792,8 @@ def on_intent(intent_request, session):
             "Conversation", 
             message, 
             attributes, 
-            cardText)
+            cardText,
+            ref)
 
     elif intent_name == "AMAZON.HelpIntent":
         return handle_help_request(attributes)
@@ -344,7 +804,12 @@ def on_intent(intent_request, session):
 
     # Get Eliza to repeat last response stored in session attributes
     elif intent_name == "AMAZON.RepeatIntent":
-        message = attributes["lastRsp"]
+        script = locale_script(intent_request.get("locale"))
+        message = stored_response(attributes["lastRsp"], script)
+        if message is None:
+            # the line is gone, say the first catch-all line of the script instead
+            message = (psychobabble if script is None else script.psychobabble)[-1][1][0]
+            attributes["lastRsp"] = message
 
         cardText = "You: repeat\n" + \
                    "Eliza: " + message
@@ -353,7 +818,8 @@ def on_intent(intent_request, session):
             "Conversation", 
             message, 
             attributes, 
-            cardText)
+            cardText,
+            attributes["lastRsp"])
 
     elif intent_name == "AMAZON.StopIntent" or intent_name == "AMAZON.CancelIntent":
         return handle_session_end_request()
@@ -379,12 +845,656 @@ def initialise_attributes(attributes):
 def id_generator(size=6, chars=string.ascii_uppercase + string.digits):
 	return ''.join(random.choice(chars) for _ in range(size))
 
+# ------------------------------ Session attributes codec ------------------------------------
+# All session state is packed into one base64 string under sessionStateKey:
+#   version byte, flags byte (1 = zlib), then fields of (tag varint, length varint, data).
+# Fields with unknown tags are skipped, so newer fields don't break older decoders.
+# Attributes in the plain dict format (older sessions) are still accepted, so the codec can be switched
+# on and off. Off by default: on Python 2.7 packing and unpacking cost more than the smaller JSON saves
+# (at 10 turns about 65 us against a 25 us JSON round trip); turn it on where the attribute size matters.
+sessionCodec = False
+sessionStateKey = "s"
+sessionCodecVersion = 1
+# zlib is only tried for payloads of at least this many bytes - it doesn't pay off for small ones
+sessionZlibMinSize = 96
+
+FLAG_ZLIB = 1
+TAG_SESSION_ID = 1
+TAG_LAST_TEXT = 2
+TAG_LAST_REF = 3
+TAG_USED = 4
+TAG_TURN = 5
+TAG_TOPICS = 6
+# any other attributes, as JSON
+TAG_EXTRA = 15
+
+
+def put_varint(out, value):
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def get_varint(data, pos):
+    value = 0
+    shift = 0
+    while True:
+        b = data[pos]
+        pos += 1
+        value |= (b & 0x7f) << shift
+        if b < 0x80:
+            return value, pos
+        shift += 7
+
+
+def put_string(out, text):
+    data = text if isinstance(text, bytes) else text.encode("utf-8")
+    put_varint(out, len(data))
+    out.extend(bytearray(data))
+
+
+def get_string(data, pos):
+    size, pos = get_varint(data, pos)
+    return bytes(data[pos:pos + size]).decode("utf-8"), pos + size
+
+
+def put_field(out, tag, field):
+    put_varint(out, tag)
+    put_varint(out, len(field))
+    out.extend(field)
+
+
+def encode_used(usedLines):
+    """ Rules with used lines as (rule number delta, bitset of used line numbers) """
+    field = bytearray()
+    rules = [(num, lines) for num, lines in enumerate(usedLines) if lines]
+    put_varint(field, len(rules))
+    previous = 0
+    for num, lines in rules:
+        bits = bytearray((max(lines) >> 3) + 1)
+        for nr in lines:
+            bits[nr >> 3] |= 1 << (nr & 7)
+        put_varint(field, num - previous)
+        put_varint(field, len(bits))
+        field.extend(bits)
+        previous = num
+    return field
+
+
+def decode_used(data):
+    usedLines = [[] for i in range(len(psychobabble))]
+    count, pos = get_varint(data, 0)
+    num = 0
+    for i in range(count):
+        delta, pos = get_varint(data, pos)
+        size, pos = get_varint(data, pos)
+        num += delta
+        while num >= len(usedLines):
+            usedLines.append([])
+        lines = usedLines[num]
+        for byteNr in range(size):
+            b = data[pos + byteNr]
+            bit = 0
+            while b:
+                if b & 1:
+                    lines.append((byteNr << 3) + bit)
+                b >>= 1
+                bit += 1
+        pos += size
+    return usedLines
+
+
+# encoders of the known attributes, each returns a list of (tag, field)
+def encode_last_response(lastRsp):
+    field = bytearray()
+    if isinstance(lastRsp, list):
+        put_varint(field, lastRsp[0])
+        put_varint(field, lastRsp[1])
+        put_varint(field, len(lastRsp) - 2)
+        for group in lastRsp[2:]:
+            put_string(field, group)
+        return [(TAG_LAST_REF, field)]
+    put_string(field, lastRsp)
+    return [(TAG_LAST_TEXT, field)]
+
+
+def encode_session_id(sessionId):
+    field = bytearray()
+    put_string(field, sessionId)
+    return [(TAG_SESSION_ID, field)]
+
+
+def encode_used_lines(usedLines):
+    return [(TAG_USED, encode_used(usedLines))]
+
+
+def encode_turn(turn):
+    field = bytearray()
+    put_varint(field, turn)
+    return [(TAG_TURN, field)]
+
+
+def encode_topics(ring):
+    if not ring:
+        # an empty ring is the default
+        return []
+    field = bytearray()
+    put_varint(field, ring)
+    return [(TAG_TOPICS, field)]
+
+
+attributeEncoders = {
+    "chatbotSessionId": encode_session_id,
+    "lastRsp": encode_last_response,
+    "used": encode_used_lines,
+    "turn": encode_turn,
+    "topics": encode_topics,
+}
+
+
+def decode_field(tag, data, attributes):
+    if tag == TAG_SESSION_ID:
+        attributes["chatbotSessionId"] = get_string(data, 0)[0]
+    elif tag == TAG_LAST_TEXT:
+        attributes["lastRsp"] = get_string(data, 0)[0]
+    elif tag == TAG_LAST_REF:
+        num, pos = get_varint(data, 0)
+        lineNr, pos = get_varint(data, pos)
+        count, pos = get_varint(data, pos)
+        ref = [num, lineNr]
+        for i in range(count):
+            group, pos = get_string(data, pos)
+            ref.append(group)
+        attributes["lastRsp"] = ref
+    elif tag == TAG_USED:
+        attributes["used"] = decode_used(data)
+    elif tag == TAG_TURN:
+        attributes["turn"] = get_varint(data, 0)[0]
+    elif tag == TAG_TOPICS:
+        attributes["topics"] = get_varint(data, 0)[0]
+    elif tag == TAG_EXTRA:
+        attributes.update(json.loads(get_string(data, 0)[0]))
+
+
+def encode_session_attributes(attributes):
+    """ Pack session attributes into {sessionStateKey: base64 string} """
+    if not attributes:
+        return attributes
+    payload = bytearray()
+    extra = {}
+    for key, value in attributes.items():
+        if key in attributeEncoders:
+            for tag, field in attributeEncoders[key](value):
+                put_field(payload, tag, field)
+        else:
+            extra[key] = value
+    if extra:
+        field = bytearray()
+        put_string(field, json.dumps(extra))
+        put_field(payload, TAG_EXTRA, field)
+
+    flags = 0
+    if len(payload) >= sessionZlibMinSize:
+        compressed = zlib.compress(bytes(payload))
+        if len(compressed) < len(payload):
+            payload = bytearray(compressed)
+            flags |= FLAG_ZLIB
+    packed = bytearray([sessionCodecVersion, flags]) + payload
+    import base64
+    return {sessionStateKey: base64.b64encode(bytes(packed)).decode("ascii")}
+
+
+def decode_session_attributes(attributes):
+    """ Unpack attributes made by encode_session_attributes; plain dict attributes are returned as they are """
+    if not attributes or sessionStateKey not in attributes:
+        return attributes
+    import base64
+    data = bytearray(base64.b64decode(attributes[sessionStateKey]))
+    version, flags = data[0], data[1]
+    if version > sessionCodecVersion:
+        # written by a newer release (e.g. before a rollback) - start the session over rather than fail the turn
+        print("session: state version %d is newer than %d, restarted" % (version, sessionCodecVersion))
+        return {}
+    data = data[2:]
+    if flags & FLAG_ZLIB:
+        data = bytearray(zlib.decompress(bytes(data)))
+    decoded = {}
+    pos = 0
+    while pos < len(data):
+        tag, pos = get_varint(data, pos)
+        size, pos = get_varint(data, pos)
+        decode_field(tag, data[pos:pos + size], decoded)
+        pos += size
+    return decoded
+
+
+def encode_response(response):
+    if sessionCodec and response and response.get("sessionAttributes"):
+        response["sessionAttributes"] = encode_session_attributes(response["sessionAttributes"])
+    return response
+
+# --------------------------------- Transcript log --------------------------------------------
+# Optional log of every TellEliza turn for rule tuning and load replay, written to transcriptFile
+# (e.g. /tmp/eliza.transcript) as fixed-size binary records in an append-only memory-mapped file.
+# Turns only queue a tuple; a background thread packs and writes them (records queued when Lambda
+# freezes the container are written on its next turn). One writer process per file.
+#
+#   header (64 bytes): magic "ELZT", version, record size, record count
+#   record (128 bytes): session id, turn, timestamp, matched rule, response line, answering rule,
+#                       latency in us, input (UTF-8, truncated), request locale
+# The matched rule is the one find_match() gives for the input; the answering rule differs from it when
+# retrieval or a topic answered instead, and the response line is one of its lines. Rules and line are -1
+# when the response did not come from a rule (e.g. from the web Eliza), otherwise they refer to the script
+# of the locale (the built-in one for locales without a script, see locale_script).
+transcriptFile = os.environ.get("ELIZA_TRANSCRIPT", "")
+# the file grows by this many bytes at a time
+transcriptChunkSize = 1 << 20
+# the writer waits this long after the first queued record, so it writes batches after the requests finished
+transcriptFlushDelay = 0.05
+
+TRANSCRIPT_MAGIC = b"ELZT"
+TRANSCRIPT_VERSION = 3
+TRANSCRIPT_HEADER = "<4sHHQ"
+TRANSCRIPT_HEADER_SIZE = 64
+TRANSCRIPT_RECORD = "<8sIdhhhI93s5s"
+# version 1 records had no locale, version 2 records no answering rule (their rule is the answering one)
+TRANSCRIPT_RECORD_V1 = "<8sIdhhI96s4x"
+TRANSCRIPT_RECORD_V2 = "<8sIdhhI95s5s"
+TRANSCRIPT_RECORD_SIZE = 128
+TRANSCRIPT_TEXT_SIZE = 93
+
+
+def utf8(text):
+    return text if isinstance(text, bytes) else text.encode("utf-8")
+
+
+class TranscriptWriter(object):
+    """ Appends transcript records to path. record() only queues the turn, the records are
+    written by a daemon thread (or by flush()) so the request never waits for the file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.pending = deque()
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        self.thread = None
+        self.file = None
+        self.map = None
+        self.count = 0
+        # True while the writer thread waits for records
+        self.idle = True
+
+    def record(self, sessionId, turn, text, rule, line, latency, locale="", answered=None):
+        answered = rule if answered is None else answered
+        self.pending.append((sessionId, turn, time.time(), rule, line, answered, latency, locale, text))
+        if self.idle:
+            self.wake.set()
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def run(self):
+        while True:
+            self.idle = True
+            if not self.pending:
+                self.wake.wait()
+            self.wake.clear()
+            self.idle = False
+            time.sleep(transcriptFlushDelay)
+            self.flush()
+
+    def open(self):
+        import mmap
+        exists = os.path.exists(self.path) and os.path.getsize(self.path) >= TRANSCRIPT_HEADER_SIZE
+        self.file = open(self.path, "r+b" if exists else "w+b")
+        if exists:
+            header = struct.unpack(TRANSCRIPT_HEADER, self.file.read(struct.calcsize(TRANSCRIPT_HEADER)))
+            if header[0] != TRANSCRIPT_MAGIC or header[2] != TRANSCRIPT_RECORD_SIZE:
+                raise ValueError("%s is not a transcript file" % self.path)
+            if header[1] != TRANSCRIPT_VERSION:
+                raise ValueError("%s has transcript version %d, expected %d" % (self.path, header[1], TRANSCRIPT_VERSION))
+            self.count = header[3]
+        else:
+            self.file.truncate(transcriptChunkSize)
+        self.map = mmap.mmap(self.file.fileno(), os.path.getsize(self.path))
+        if not exists:
+            self.write_header()
+
+    def write_header(self):
+        struct.pack_into(TRANSCRIPT_HEADER, self.map, 0, TRANSCRIPT_MAGIC, TRANSCRIPT_VERSION,
+                         TRANSCRIPT_RECORD_SIZE, self.count)
+
+    def grow(self, size):
+        import mmap
+        self.map.close()
+        size = (size // transcriptChunkSize + 1) * transcriptChunkSize
+        self.file.truncate(size)
+        self.map = mmap.mmap(self.file.fileno(), size)
+
+    def flush(self):
+        """ Write the queued records; the header count is updated after them, so readers never see a partial record """
+        with self.lock:
+            if not self.pending:
+                return
+            if self.map is None:
+                self.open()
+            pos = TRANSCRIPT_HEADER_SIZE + self.count * TRANSCRIPT_RECORD_SIZE
+            while self.pending:
+                sessionId, turn, timestamp, rule, line, answered, latency, locale, text = self.pending.popleft()
+                if pos + TRANSCRIPT_RECORD_SIZE > len(self.map):
+                    self.grow(pos + TRANSCRIPT_RECORD_SIZE)
+                struct.pack_into(TRANSCRIPT_RECORD, self.map, pos, utf8(sessionId)[:8], turn, timestamp, rule, line,
+                                 answered, min(latency, 0xffffffff), utf8(text)[:TRANSCRIPT_TEXT_SIZE],
+                                 utf8(locale)[:5])
+                pos += TRANSCRIPT_RECORD_SIZE
+                self.count += 1
+            self.write_header()
+
+    def close(self):
+        self.flush()
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+                self.map.close()
+                self.file.close()
+                self.map = None
+
+
+def read_transcript(path):
+    """ Yield the records of a transcript file as
+    (session id, turn, timestamp, matched rule, line, latency in us, input, locale, answering rule) tuples
+    ("" for the locale of version 1 records; the logged rule as both rules of version 1 and 2 records)
+    """
+    import mmap
+    with open(path, "rb") as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, recordSize, count = struct.unpack_from(TRANSCRIPT_HEADER, data, 0)
+            if magic != TRANSCRIPT_MAGIC or recordSize != TRANSCRIPT_RECORD_SIZE:
+                raise ValueError("%s is not a transcript file" % path)
+            record = struct.Struct({1: TRANSCRIPT_RECORD_V1, 2: TRANSCRIPT_RECORD_V2}.get(version, TRANSCRIPT_RECORD))
+            for pos in range(TRANSCRIPT_HEADER_SIZE, TRANSCRIPT_HEADER_SIZE + count * recordSize, recordSize):
+                fields = record.unpack_from(data, pos)
+                if version < 3:
+                    # the logged rule answered; which rule matched wasn't logged
+                    fields = fields[:5] + (fields[3],) + fields[5:]
+                sessionId, turn, timestamp, rule, line, answered, latency, text = fields[:8]
+                locale = fields[8].rstrip(b"\0").decode("ascii") if len(fields) > 8 else ""
+                yield (sessionId.rstrip(b"\0").decode("utf-8", "replace"), turn, timestamp, rule, line, latency,
+                       text.rstrip(b"\0").decode("utf-8", "ignore"), locale, answered)
+        finally:
+            data.close()
+
+
+transcriptWriter = TranscriptWriter(transcriptFile) if transcriptFile else None
+
+
+def record_turn(attributes, phrase, ref, started, locale="", script=None):
+    """ Queue the turn for the transcript log, if it is enabled; the session's turn count is kept only then """
+    if transcriptWriter is None:
+        return
+    attributes["turn"] = attributes.get("turn", 0) + 1
+    answered, line = (ref[0], ref[1]) if isinstance(ref, list) else (-1, -1)
+    rule = matched_rule(phrase, script) if answered >= 0 else -1
+    transcriptWriter.record(attributes["chatbotSessionId"], attributes["turn"], phrase, rule, line,
+                            int((time.time() - started) * 1e6), locale, answered)
+
+
+def matched_rule(phrase, script=None):
+    """ Number of the rule matching phrase (before retrieval or topics pick another one), -1 for none """
+    matched = find_match(prepare_statement(phrase)) if script is None else script.match(script.prepare(phrase))
+    return matched[0] if matched else -1
+
+# --------------------------------- Profiling --------------------------------------------
+# Opt-in stack sampling of slow requests. A background thread samples the stacks of requests running
+# longer than profileThresholdMs (and of a random profileSampleRate share of all requests) and writes
+# them in collapsed stack format ("frame;frame;frame count" lines) to profileOutput, or to the log
+# when it is empty. Requests which are not sampled only pay for a dictionary update.
+profiling = False
+profileThresholdMs = 500
+profileSampleRate = 0.0
+profileIntervalMs = 5
+profileOutput = ""
+
+
+class StackSampler(object):
+    """ Samples the stacks of the request threads registered with begin(). The sampling thread
+    sleeps until the oldest request could cross the threshold, so fast requests never wake it.
+    """
+
+    def __init__(self):
+        # thread id -> [start time, sample regardless of the threshold, {collapsed stack: count}]
+        self.active = {}
+        self.thread = None
+        self.lock = threading.Lock()
+        self.wake = threading.Event()
+        # True while the sampling thread waits for requests without a timeout
+        self.idle = True
+
+    def begin(self):
+        forced = random.random() < profileSampleRate
+        self.active[threading.current_thread().ident] = [time.time(), forced, {}]
+        if forced or self.idle:
+            self.wake.set()
+        if self.thread is None:
+            with self.lock:
+                if self.thread is None:
+                    self.thread = threading.Thread(target=self.run)
+                    self.thread.daemon = True
+                    self.thread.start()
+
+    def end(self):
+        entry = self.active.pop(threading.current_thread().ident, None)
+        if entry and entry[2]:
+            write_profile(entry[2], time.time() - entry[0])
+
+    def next_wait(self, now):
+        """ Seconds until the next sample is due, None if there is nothing to watch """
+        entries = list(self.active.values())
+        if not entries:
+            return None
+        interval = profileIntervalMs / 1000.0
+        if any(entry[1] for entry in entries):
+            return interval
+        return max(interval, min(entry[0] for entry in entries) + profileThresholdMs / 1000.0 - now)
+
+    def run(self):
+        while True:
+            wait = self.next_wait(time.time())
+            self.idle = wait is None
+            self.wake.wait(wait)
+            self.wake.clear()
+            self.idle = False
+            now = time.time()
+            frames = None
+            for ident, entry in list(self.active.items()):
+                if entry[1] or now - entry[0] >= profileThresholdMs / 1000.0:
+                    frames = frames or sys._current_frames()
+                    frame = frames.get(ident)
+                    if frame is not None:
+                        stack = collapse_stack(frame)
+                        entry[2][stack] = entry[2].get(stack, 0) + 1
+
+
+def collapse_stack(frame):
+    names = []
+    while frame is not None:
+        names.append(os.path.basename(frame.f_code.co_filename) + ":" + frame.f_code.co_name)
+        frame = frame.f_back
+    return ";".join(reversed(names))
+
+
+def write_profile(samples, elapsed):
+    lines = ["%s %d" % (stack, count) for stack, count in sorted(samples.items())]
+    if profileOutput:
+        with open(profileOutput, "a") as f:
+            f.write("\n".join(lines) + "\n")
+    else:
+        print("profile: %d ms, %d samples" % (elapsed * 1000, sum(samples.values())))
+        for line in lines:
+            print("profile: " + line)
+
+
+stackSampler = StackSampler()
+
+# --------------------------------- Warm-up --------------------------------------------
+# Scheduled warm-up pings ({"warmup": true} or a CloudWatch scheduled event) and provisioned
+# concurrency initialisation do the work a first turn would otherwise pay for.
+warmOnInit = os.environ.get("ELIZA_WARM_ON_INIT", "") == "1" or \
+    os.environ.get("AWS_LAMBDA_INITIALIZATION_TYPE", "") == "provisioned-concurrency"
+
+
+def is_warm_up_event(event):
+    return bool(event.get("warmup")) or event.get("source") in ("aws.events", "serverless-plugin-warmup")
+
+
+def warm_up():
+    """ Build the lazy tables, prime the caches and open the web connections """
+    started = time.time()
+    if fuzzyMatching and fuzzyIndex is None:
+        build_fuzzy_index()
+    if retrievalFallback and retrievalIndex is None:
+        build_retrieval_index()
+    attributes = {}
+    initialise_attributes(attributes)
+    message, ref = "", None
+    for phrase in samplePhrases:
+        message, ref = analyze_ref(phrase, attributes)
+        reflect(phrase)
+    response = say_message("Conversation", message, attributes, message, ref)
+    if sessionCodec:
+        decode_session_attributes(encode_session_attributes(response["sessionAttributes"]))
+
+    if elizaType == "web":
+        init_web()
+        load_queue()
+        load_urllib()
+        try:
+            webPool.prime(1, webLatencyBudget)
+        except Exception:
+            # the first turn will try again
+            pass
+    return {"warmup": "ok", "ms": int((time.time() - started) * 1000)}
+
+# --------------------------------- Admission control --------------------------------------------
+# For self-hosted deployments (one process serving many users): per-user and global token buckets
+# in front of the handler. Requests over the limits get a fixed "busy" line instead of a turn,
+# so a misbehaving client or a replay storm can't starve everybody else. SessionEndedRequests are
+# neither counted nor shed. Lambda scales per request and keeps this off.
+admissionControl = False
+# sustained turns per second and burst size for each user, and for the whole process
+userRate = 1.0
+userBurst = 10
+globalRate = 500.0
+globalBurst = 1000
+# users with a partly drained bucket kept in memory (beyond it the least recently seen are forgotten first)
+admissionMaxUsers = 20000
+# shed load is logged at most this often (seconds)
+admissionReportInterval = 60.0
+
+
+class TokenBuckets(object):
+    """ Token buckets keyed by user, each stored as a single float: the time at which the bucket is
+    full again. Full buckets need no state, so they are dropped when the table grows beyond maxKeys.
+    """
+
+    def __init__(self, rate, burst, maxKeys):
+        self.interval = 1.0 / rate
+        # a microsecond of slack, so rounding errors don't cost the last token of a burst
+        self.limit = burst * self.interval + 1e-6
+        self.maxKeys = maxKeys
+        # a plain dict is much faster than OrderedDict on Python 2; re-inserting keeps it in LRU order on Python 3.7+
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def take(self, key, now):
+        """ Take a token from key's bucket, False if it is empty """
+        with self.lock:
+            fullAt = max(self.entries.pop(key, now), now) + self.interval
+            if fullAt - now > self.limit:
+                self.entries[key] = fullAt - self.interval
+                return False
+            self.entries[key] = fullAt
+            if len(self.entries) > self.maxKeys:
+                self.evict(now)
+            return True
+
+    def evict(self, now):
+        for key in [key for key, fullAt in self.entries.items() if fullAt <= now]:
+            del self.entries[key]
+        # still too many partly drained buckets: forget the least recently used quarter
+        if len(self.entries) > self.maxKeys * 3 // 4:
+            for key in list(islice(self.entries, len(self.entries) - self.maxKeys * 3 // 4)):
+                del self.entries[key]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+userBuckets = TokenBuckets(userRate, userBurst, admissionMaxUsers)
+globalBucket = TokenBuckets(globalRate, globalBurst, 1)
+admissionStats = {"admitted": 0, "shedUser": 0, "shedGlobal": 0}
+admissionReported = [time.time()]
+
+busyLine = "Sorry, I need a moment to collect my thoughts. Please say that again. "
+# built on first use and shared by all busy responses
+busySpeechlet = None
+
+
+def admit(event):
+    """ True if the request may go ahead; counts it in admissionStats """
+    now = time.time()
+    if not userBuckets.take(event['session']['user']['userId'], now):
+        admissionStats["shedUser"] += 1
+    elif not globalBucket.take(None, now):
+        admissionStats["shedGlobal"] += 1
+    else:
+        admissionStats["admitted"] += 1
+        return True
+    if now - admissionReported[0] >= admissionReportInterval:
+        admissionReported[0] = now
+        print("admission: " + json.dumps(admission_metrics()))
+    return False
+
+
+def admission_metrics():
+    metrics = dict(admissionStats)
+    metrics["trackedUsers"] = len(userBuckets)
+    return metrics
+
+
+def busy_response(event):
+    """ The degraded response of a shed request; the session attributes are passed back untouched """
+    global busySpeechlet
+    if busySpeechlet is None:
+        busySpeechlet = build_speechlet_response("Eliza", busyLine, "Please say that again. ", False)
+    return build_response(event['session'].get('attributes') or {}, busySpeechlet)
+
 # --------------------------------- Main handler --------------------------------------------
 
 def lambda_handler(event, context):
+    """ Entry point of the Lambda function, see handle_event() """
+    if not profiling:
+        return handle_event(event, context)
+    stackSampler.begin()
+    try:
+        return handle_event(event, context)
+    finally:
+        stackSampler.end()
+
+
+def handle_event(event, context):
     """ Route the incoming request based on type (LaunchRequest, IntentRequest,
     etc.) The JSON body of the request is provided in the event parameter.
     """
+    if is_warm_up_event(event):
+        return warm_up()
+
 #    print("event.session.application.applicationId=" +
 #    event['session']['application']['applicationId'])
 
@@ -392,14 +1502,21 @@ def lambda_handler(event, context):
     if (event['session']['application']['applicationId'] != "amzn1.ask.skill.df26fd2c-e0bc-47a3-8553-49023a8a67b7"):
          raise ValueError("Invalid Application ID")
 
+    # a SessionEndedRequest takes no speech (Alexa rejects a response with it) and costs nothing, so it's never shed
+    if admissionControl and event['request']['type'] != "SessionEndedRequest" and not admit(event):
+        return busy_response(event)
+
+    if event['session'].get('attributes'):
+        event['session']['attributes'] = decode_session_attributes(event['session']['attributes'])
+
     if event['session']['new']:
         on_session_started({'requestId': event['request']['requestId']},
                            event['session'])
 
     if event['request']['type'] == "LaunchRequest":
-        return on_launch(event['request'], event['session'])
+        return encode_response(on_launch(event['request'], event['session']))
     elif event['request']['type'] == "IntentRequest":
-        return on_intent(event['request'], event['session'])
+        return encode_response(on_intent(event['request'], event['session'], event.get('context')))
     elif event['request']['type'] == "SessionEndedRequest":
         return on_session_ended(event['request'], event['session'])                         
 
@@ -410,6 +1527,8 @@ def lambda_handler(event, context):
 #  extended to include more responses and a less random response mechanism (response "memory")
 #---------------------------------------------------------------------------------------------
 
+import io
+import math
 import re
 import random
 
@@ -1052,6 +2171,42 @@ psychobabble = [
       "How do you feel when you say that?"]]
 ]
 
+# freeze the script into interned tuples, shared by all sessions
+psychobabble = tuple((intern(pattern), tuple(intern(r) for r in responses)) for pattern, responses in psychobabble)
+
+
+# compiled patterns shared by all rule tables (the built-in script and the locale scripts), so identical
+# patterns are compiled and kept once: pattern -> [regex, number of rules using it]
+sharedRegexes = {}
+
+
+def compile_pattern(pattern):
+    entry = sharedRegexes.get(pattern)
+    if entry is None:
+        entry = sharedRegexes[pattern] = [re.compile(pattern), 0]
+    entry[1] += 1
+    return entry[0]
+
+
+def release_pattern(pattern):
+    entry = sharedRegexes[pattern]
+    entry[1] -= 1
+    if entry[1] == 0:
+        del sharedRegexes[pattern]
+
+
+class Rule(object):
+    """ A psychobabble rule with its pattern compiled once at load time """
+    __slots__ = ("pattern", "regex", "responses")
+
+    def __init__(self, pattern, responses):
+        self.pattern = pattern
+        self.regex = compile_pattern(pattern)
+        self.responses = responses
+
+
+ruleTable = tuple(Rule(pattern, responses) for pattern, responses in psychobabble)
+
 
 def reflect(fragment):
     tokens = fragment.lower().split()
@@ -1061,57 +2216,826 @@ def reflect(fragment):
     return ' '.join(tokens)
 
 
-def analyze(statement, attributes):
-    statement = statement.lower()
-    num = 0
-    for pattern, responses in psychobabble:
-        match = re.match(pattern, statement.rstrip(".!"))
-        if match:
-#            response = random.choice(responses)
-#            return response.format(*[reflect(g) for g in match.groups()])
+# --------------------------- Input normalization -------------------------------
+# Alexa transcriptions vary ("o. k.", "do not", "2", stray punctuation), so statements are rewritten
+# to the forms the script's patterns are written for before they reach the matcher.
+
+class BoundedCache(object):
+    """ Small LRU cache - the least recently used entry is dropped once maxSize is reached """
+
+    def __init__(self, maxSize):
+        self.maxSize = maxSize
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value = self.entries.pop(key)
+            except KeyError:
+                return default
+            self.entries[key] = value
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = value
+            if len(self.entries) > self.maxSize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+# punctuation which never takes part in matching is turned into spaces; ' ? . ! are kept for the patterns,
+# and : is only kept between digits (3:30, see normalizeRegex)
+normalizeTable = dict((ord(c), u" ") for c in u",;\"()[]{}<>*_~|\\/\t\r\n")
+
+# word level rewrites (contractions in the form the patterns expect, ASR spellings). Digits are left alone:
+# no rule keys on number words, and "3:30" or "2.5" must come back as the user said them
+normalizeWords = {
+    "do not": "don't",
+    "cannot": "can't",
+    "can not": "can't",
+    "okay": "ok",
+    "wanna": "want to",
+    "gonna": "going to",
+    "gotta": "got to",
+    "cos": "because",
+    "cuz": "because",
+    "coz": "because",
+}
+
+# one regex for all rewrites: spelled out letters ("o. k." -> "ok"), any of the words above or a colon
+# which isn't part of a time
+normalizeRegex = re.compile(r"(?<![a-z'])((?:[a-z]\. ?){2,})|\b(" +
+                            "|".join(re.escape(w) for w in sorted(normalizeWords, key=len, reverse=True)) +
+                            r")\b|(?<![0-9]):|:(?![0-9])")
+normalizeCache = BoundedCache(512)
+
+
+def _normalize_match(match):
+    if match.group(1):
+        return match.group(1).replace(".", "").replace(" ", "") + " "
+    if match.group(2):
+        return normalizeWords[match.group(2)]
+    return " "
+
+
+def normalize_input(statement):
+    """ Lower case, drop punctuation the script doesn't use, rewrite contractions and spellings,
+    and collapse whitespace """
+    normalized = normalizeCache.get(statement)
+    if normalized is None:
+        text = statement if isinstance(statement, type(u"")) else statement.decode("utf-8")
+        text = text.lower().translate(normalizeTable)
+        normalized = " ".join(normalizeRegex.sub(_normalize_match, text).split())
+        normalizeCache.put(statement, normalized)
+    return normalized
+
+
+# stages applied, in order, to every statement before it reaches the matcher
+inputPipeline = [normalize_input]
 
-            # get list of lists of used line number for each paragraph
-            if "used" in attributes:
-                usedLines = attributes["used"]
-            else:
-                # if this is the first go then create a new empty list
-                usedLines = []
-                for i in range(len(psychobabble)):
-                    usedLines.append([])
-
-            # create list of unused line numbers
-            unUsedLines = []
-            for nr in range(len(responses)):
-                if nr not in usedLines[num]:
-                    unUsedLines.append(nr)
-
-            #print("unUsedLines: " + str(unUsedLines))
-
-            #10% chance of using any line (as opposed to just the unused ones)
-            if (randint(0,100)>90):
-                lineNr = randint(0,len(responses) - 1)
-            else:
-                # else use only an unused line
-                if not unUsedLines:
-                    # unused lines list empty - all lines used, so chose any index again
-                    lineNr = randint(0,len(responses) - 1)
-                    # clear used lines list
-                    usedLines[num] = []
-                else:
-                    # select index from list of unused lines
-                    lineNr = unUsedLines[randint(0,len(unUsedLines) - 1)]
 
-            # add used line number to list
-            usedLines[num].append(lineNr)
+def prepare_statement(statement):
+    for stage in inputPipeline:
+        statement = stage(statement)
+    return statement
 
-            # get the selected response
-            response = responses[lineNr]
 
-            # save new used lines in attributes
-            attributes["used"] = usedLines
+# --------------------------- Matching and response selection -------------------------------
+
+def match_rules(statement):
+    """ Reference matcher: (rule number, matched groups) of the first rule matching the statement """
+    statement = statement.rstrip(".!")
+    num = 0
+    for rule in ruleTable:
+        match = rule.regex.match(statement)
+        if match:
+            return num, match.groups()
+        num = num + 1
+    return None
 
-            # return selected line after some final formatting
-            return response.format(*[reflect(g) for g in match.groups()])
 
+def select_line(num, attributes, lines=None, script=None):
+    """ Pick a line number of rule num (out of lines, all by default), preferring lines not used yet in this session """
+    table = psychobabble if script is None else script.psychobabble
+    responses = table[num][1]
+    if lines is None:
+        lines = range(len(responses))
+
+    # get list of lists of used line number for each paragraph
+    if "used" in attributes:
+        usedLines = attributes["used"]
+    else:
+        # if this is the first go then create a new empty list
+        usedLines = []
+        for i in range(len(table)):
+            usedLines.append([])
+    # a locale script may have more rules than the session was created with
+    while len(usedLines) <= num:
+        usedLines.append([])
+
+    # create list of unused line numbers
+    unUsedLines = []
+    for nr in lines:
+        if nr not in usedLines[num]:
+            unUsedLines.append(nr)
+
+    #print("unUsedLines: " + str(unUsedLines))
+
+    #10% chance of using any line (as opposed to just the unused ones)
+    if (randint(0,100)>90):
+        lineNr = lines[randint(0,len(lines) - 1)]
+    else:
+        # else use only an unused line
+        if not unUsedLines:
+            # unused lines list empty - all lines used, so chose any index again
+            lineNr = lines[randint(0,len(lines) - 1)]
+            # clear used lines list
+            usedLines[num] = []
         else:
+            # select index from list of unused lines
+            lineNr = unUsedLines[randint(0,len(unUsedLines) - 1)]
+
+    # add used line number to list
+    usedLines[num].append(lineNr)
+
+    # save new used lines in attributes
+    attributes["used"] = usedLines
+    return lineNr
+
+
+def response_ref(num, lineNr, groups, script=None):
+    """ Compact reference of a response line: [rule, line] plus the reflected groups if the line uses them """
+    if script is not None:
+        if "{" in script.psychobabble[num][1][lineNr]:
+            return [num, lineNr] + [script.reflect(g) for g in groups]
+    elif "{" in psychobabble[num][1][lineNr]:
+        return [num, lineNr] + [reflect(g) for g in groups]
+    return [num, lineNr]
+
+
+def expand_response(ref, script=None):
+    """ Response text of a reference made by response_ref (plain text is returned as is) """
+    if isinstance(ref, list):
+        table = psychobabble if script is None else script.psychobabble
+        return table[ref[0]][1][ref[1]].format(*ref[2:])
+    return ref
+
+
+def stored_response(ref, script=None):
+    """ Response text of a stored lastRsp, or None if the reference doesn't fit the script (a session
+    started before a deploy which changed the script, or a damaged attribute) """
+    if not isinstance(ref, list):
+        return ref
+    table = psychobabble if script is None else script.psychobabble
+    try:
+        num, lineNr = ref[0], ref[1]
+        if not (0 <= num < len(table) and 0 <= lineNr < len(table[num][1])):
+            return None
+        line = table[num][1][lineNr]
+        # a line with placeholders is stored with all groups of its rule, a constant one without any
+        if len(ref) - 2 != (re.compile(table[num][0]).groups if "{" in line else 0):
+            return None
+        return line.format(*ref[2:])
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def analyze_ref(statement, attributes, script=None):
+    """ Return the response to statement and its compact reference, using a locale script
+    (see locale_script) instead of the built-in one if given """
+    if script is not None:
+        return script.analyze_ref(statement, attributes)
+    statement = prepare_statement(statement)
+    matched = find_match(statement)
+    if fuzzyMatching and matched and (matched[0] == catchAllRule or matched[0] in topicGenericRules):
+        statement, matched = fuzzy_match(statement, matched)
+    if matched:
+#        response = random.choice(psychobabble[matched[0]][1])
+#        return response.format(*[reflect(g) for g in matched[1]])
+        ring = attributes.get("topics", 0)
+        if topicContext:
+            matched, topic = topic_match(statement, matched, ring)
+            if ring or topic is not None:
+                # a session without topics keeps an empty ring, which isn't stored
+                attributes["topics"] = push_topic(ring, topic)
+        if matched[0] == catchAllRule:
+            ref = catch_all_ref(statement, attributes, ring)
+            if ref is not None:
+                return expand_response(ref), ref
+        ref = response_ref(matched[0], select_line(matched[0], attributes), matched[1])
+        return expand_response(ref), ref
+    return None, None
+
+
+def catch_all_ref(statement, attributes, ring):
+    """ Reference of a more specific line than the catch-all ones for an otherwise unmatched statement, or None """
+    if retrievalFallback:
+        retrieved = retrieve_rule(statement)
+        if retrieved is not None:
+            if topicContext:
+                attributes["topics"] = push_topic(ring, retrieved)
+            return [retrieved, select_line(retrieved, attributes, constantLines[retrieved])]
+    if topicContext and randint(0, 99) < topicFollowUpChance:
+        topic = active_topic(ring)
+        if topic is not None:
+            return [topic, select_line(topic, attributes, constantLines[topic])]
+    return None
+
+
+def analyze(statement, attributes):
+    return analyze_ref(statement, attributes)[0]
+
+
+# --------------------------- Fuzzy keyword matching -------------------------------
+# Optional correction of misrecognized words ("mothr", "fam ily") to the nearest keyword of the script,
+# for statements only a generic rule ("my (.*)", see topicGenericOpeners) or the catch-all rule matches: a
+# statement a specific rule understands keeps its words.
+# Words the script knows (in patterns, responses or reflections) and the real words close to a keyword
+# listed in fuzzyWordsFile (farther, fried; written by tools/fuzzy_words.py) are never touched.
+fuzzyMatching = False
+# bounds of the keyword index and the per-word correction cache
+fuzzyMaxKeywords = 2000
+fuzzyCacheSize = 1024
+# shortest word considered for correction, and the edit distance allowed below/above fuzzyLongWord letters
+fuzzyMinLength = 5
+fuzzyLongWord = 8
+fuzzyWordsFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fuzzy_words.txt")
+# everyday words which are close to a keyword but must not be "corrected" (e.g. bother -> mother)
+fuzzyCommonWords = (
+    "bother", "brother", "other", "mothers", "fathers", "rather", "gather", "leather", "feather", "whether",
+    "batch", "pitch", "ditch", "board", "bared", "boned", "cored", "borer", "chile", "chill",
+    "craze", "bunny", "sunny", "funky", "nappy", "hippy", "sappy", "hilly", "billy", "sully", "cello",
+    "hells", "worry", "steak", "sneak", "spear", "speck", "thing", "thick", "thank", "stink", "these",
+    "three", "whore", "whose", "whole", "could", "mould", "wound", "should", "laughs", "laughed",
+    "reasons", "season", "friends", "fiend", "nothings", "loving", "lover", "liked", "likes",
+    "wanted", "needs", "needed", "thinks", "names", "named", "speaks", "jokes", "joked", "loved",
+    "animals", "children", "families", "computers", "parent", "parents", "sister", "mummy", "daddy",
+)
+
+fuzzyIndex = None
+fuzzyCache = BoundedCache(fuzzyCacheSize)
+
+
+class FuzzyIndex(object):
+    """ Character trigram index over the script keywords """
+
+    def __init__(self, keywords, knownWords):
+        self.keywords = tuple(sorted(keywords))[:fuzzyMaxKeywords]
+        self.keywordSet = frozenset(self.keywords)
+        self.knownWords = frozenset(knownWords)
+        grams = {}
+        for nr, keyword in enumerate(self.keywords):
+            for gram in trigrams(keyword):
+                grams.setdefault(gram, []).append(nr)
+        self.grams = dict((gram, tuple(ids)) for gram, ids in grams.items())
+
+    def nearest(self, word):
+        """ Return the keyword closest to word, or None if nothing is close enough """
+        maxDistance = 1 if len(word) < fuzzyLongWord else 2
+        counts = {}
+        for gram in trigrams(word):
+            for nr in self.grams.get(gram, ()):
+                counts[nr] = counts.get(nr, 0) + 1
+        best = None
+        bestScore = None
+        for nr, shared in counts.items():
+            keyword = self.keywords[nr]
+            if abs(len(keyword) - len(word)) > maxDistance:
+                continue
+            distance = edit_distance(word, keyword, maxDistance)
+            if distance <= maxDistance and (best is None or (distance, -shared) < bestScore):
+                best = keyword
+                bestScore = (distance, -shared)
+        return best
+
+
+def trigrams(word):
+    padded = "^" + word + "$"
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+def edit_distance(a, b, maxDistance):
+    """ Edit distance of a and b counting swapped neighbour letters as one edit,
+    giving up (returning maxDistance + 1) once maxDistance is exceeded
+    """
+    beforePrevious = None
+    previous = list(range(len(b) + 1))
+    for i, ca in enumerate(a):
+        current = [i + 1]
+        for j, cb in enumerate(b):
+            cost = min(previous[j + 1] + 1, current[j] + 1, previous[j] + (ca != cb))
+            if i and j and ca == b[j - 1] and a[i - 1] == cb:
+                cost = min(cost, beforePrevious[j - 1] + 1)
+            current.append(cost)
+        if min(current) > maxDistance:
+            return maxDistance + 1
+        beforePrevious = previous
+        previous = current
+    return previous[-1]
+
+
+def script_words(text):
+    return re.findall(r"[a-z][a-z']*", re.sub('<[^<]+>', " ", text.lower()))
+
+
+def build_fuzzy_index():
+    """ Collect keywords (literal words of the patterns) and all other words the script knows """
+    global fuzzyIndex
+    keywords = set()
+    knownWords = set(reflections.keys()) | set(" ".join(reflections.values()).split()) | set(fuzzyCommonWords)
+    for pattern, responses in psychobabble:
+        literal = re.sub(r"\([^)]*\)|\[[^\]]*\]|\\\??|\?", " ", pattern.replace("\\'?", "'"))
+        for word in script_words(literal):
+            knownWords.add(word)
+            if len(word) >= fuzzyMinLength:
+                keywords.add(word)
+        for response in responses:
+            knownWords.update(script_words(response))
+    if fuzzyWordsFile and os.path.exists(fuzzyWordsFile):
+        with open(fuzzyWordsFile) as f:
+            knownWords.update(line.strip() for line in f)
+    fuzzyIndex = FuzzyIndex(keywords, knownWords)
+    fuzzyCache.clear()
+    return fuzzyIndex
+
+
+def correct_word(word):
+    corrected = fuzzyCache.get(word)
+    if corrected is None:
+        corrected = word
+        if len(word) >= fuzzyMinLength and word not in fuzzyIndex.knownWords:
+            corrected = fuzzyIndex.nearest(word) or word
+        fuzzyCache.put(word, corrected)
+    return corrected
+
+
+def fuzzy_correct(statement):
+    """ Join split keywords and replace unknown words by their nearest keyword """
+    if not fuzzyMatching:
+        return statement
+    if fuzzyIndex is None:
+        build_fuzzy_index()
+    tokens = statement.split()
+    words = []
+    i = 0
+    while i < len(tokens):
+        token = tokens[i]
+        # "fam ily" -> "family"
+        if i + 1 < len(tokens) and token + tokens[i + 1] in fuzzyIndex.keywordSet and \
+                not (token in fuzzyIndex.knownWords and tokens[i + 1] in fuzzyIndex.knownWords):
+            words.append(token + tokens[i + 1])
+            i += 2
+            continue
+        word = token.rstrip("?.!")
+        words.append(correct_word(word) + token[len(word):] if word else token)
+        i += 1
+    return " ".join(words)
+
+
+def fuzzy_match(statement, matched):
+    """ (statement, match) for a statement only a generic or the catch-all rule matches: the corrected
+    statement and its match, or both unchanged if there is nothing to correct """
+    corrected = fuzzy_correct(statement)
+    if corrected != statement:
+        return corrected, find_match(corrected)
+    return statement, matched
+
+
+if fuzzyMatching:
+    build_fuzzy_index()
+
+
+# --------------------------- Retrieval fallback -------------------------------
+# When nothing but the generic (.*) rule matches, the rule most similar to the statement (TF-IDF
+# cosine over the rule's keywords and, weighted lower, responses) answers instead, with one of its lines which don't
+# need captured groups. Scoring a statement only touches the postings of its words; NumPy, when
+# installed, is imported to score batches of statements (offline evaluation) with one matrix product.
+retrievalFallback = True
+# minimum cosine similarity for a retrieved rule to be used, and the weight of the words of a rule's responses
+# relative to its keywords; tuned with the labelled statements of tools/bench.py retrieval (no unrelated rule
+# retrieved, such as the joke rule for "the weather is nice" through a word of the joke)
+retrievalMinScore = 0.35
+retrievalResponseWeight = 0.7
+# words too common to say anything about the topic
+retrievalStopWords = frozenset((
+    "the", "and", "you", "your", "are", "that", "this", "what", "with", "for", "have", "about", "was",
+    "not", "can", "does", "why", "how", "tell", "more", "would", "think", "feel", "say", "said", "really",
+    "it's", "i'm", "don't", "let's", "there", "then", "than", "when", "who", "me", "my", "it", "do", "is",
+    "so", "be", "to", "of", "in", "a", "i", "am", "all", "any", "just", "some", "much", "very", "yes", "no",
+    "bad", "good", "nice", "lot", "well", "thank", "thanks", "today", "know", "get", "got", "make", "want",
+    "one", "now", "here", "out", "too", "also", "again", "maybe", "sure", "see", "let", "talk", "talking"))
+
+catchAllRule = len(psychobabble) - 1
+# line numbers of each rule which don't use captured groups
+constantLines = tuple(tuple(nr for nr, line in enumerate(responses) if "{" not in line)
+                      for pattern, responses in psychobabble)
+
+
+def retrieval_terms(text):
+    return [word for word in script_words(text) if len(word) > 2 and word not in retrievalStopWords]
+
+
+class RetrievalIndex(object):
+    """ TF-IDF vectors (unit length) of documents, one per candidate rule """
+
+    def __init__(self, documents, responseWeight=1.0):
+        # documents: list of (rule number, keywords, responses); the terms of the responses count
+        # responseWeight times as much as the keywords
+        self.rules = tuple(num for num, keywords, responses in documents)
+        counts = []
+        frequency = {}
+        for num, keywords, responses in documents:
+            tf = {}
+            for text, weight in ((keywords, 1.0), (responses, responseWeight)):
+                if not weight:
+                    continue
+                part = {}
+                for term in retrieval_terms(text):
+                    part[term] = part.get(term, 0) + 1
+                for term, n in part.items():
+                    tf[term] = tf.get(term, 0.0) + (1.0 + math.log(n)) * weight
+            counts.append(tf)
+            for term in tf:
+                frequency[term] = frequency.get(term, 0) + 1
+        self.idf = dict((term, math.log(float(len(documents)) / n) + 1.0) for term, n in frequency.items())
+        self.terms = dict((term, i) for i, term in enumerate(sorted(self.idf)))
+
+        postings = {}
+        for doc, tf in enumerate(counts):
+            weights = dict((term, w * self.idf[term]) for term, w in tf.items())
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for term, w in weights.items():
+                postings.setdefault(term, []).append((doc, w / norm))
+        # dense terms x documents matrix, built by the first query_batch()
+        self.matrix = None
+        self.postings = dict((term, tuple(p)) for term, p in postings.items())
+
+    def query_weights(self, statement):
+        tf = {}
+        for term in retrieval_terms(statement):
+            if term in self.idf:
+                tf[term] = tf.get(term, 0) + 1
+        weights = dict((term, (1.0 + math.log(n)) * self.idf[term]) for term, n in tf.items())
+        norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+        return dict((term, w / norm) for term, w in weights.items())
+
+    def best(self, scores):
+        if not scores:
+            return None, 0.0
+        doc = max(scores, key=lambda d: (scores[d], -d))
+        return self.rules[doc], scores[doc]
+
+    def query(self, statement):
+        """ (rule number, score) of the most similar rule, (None, 0.0) if no word is known """
+        scores = {}
+        for term, w in self.query_weights(statement).items():
+            for doc, dw in self.postings[term]:
+                scores[doc] = scores.get(doc, 0.0) + w * dw
+        return self.best(scores)
+
+    def query_batch(self, statements):
+        """ query() for many statements, with a single matrix product when NumPy is available """
+        try:
+            import numpy
+        except ImportError:
+            return [self.query(statement) for statement in statements]
+        if self.matrix is None:
+            self.matrix = numpy.zeros((len(self.terms), len(self.rules)), dtype=numpy.float32)
+            for term, postings in self.postings.items():
+                for doc, w in postings:
+                    self.matrix[self.terms[term], doc] = w
+        queries = numpy.zeros((len(statements), len(self.terms)), dtype=numpy.float32)
+        for row, statement in enumerate(statements):
+            for term, w in self.query_weights(statement).items():
+                queries[row, self.terms[term]] = w
+        scores = queries.dot(self.matrix)
+        results = []
+        for row in range(len(statements)):
+            doc = int(scores[row].argmax())
+            score = float(scores[row, doc])
+            results.append((self.rules[doc], score) if score > 0 else (None, 0.0))
+        return results
+
+
+def build_retrieval_index():
+    global retrievalIndex
+    documents = []
+    for num, (pattern, responses) in enumerate(psychobabble):
+        if num == catchAllRule or not constantLines[num] or pattern.startswith("(.*)\\?"):
+            continue
+        literal = re.sub(r"\([^)]*\)|\[[^\]]*\]|\\\??|\?", " ", pattern.replace("\\'?", "'"))
+        documents.append((num, literal, " ".join(responses[nr] for nr in constantLines[num])))
+    retrievalIndex = RetrievalIndex(documents, retrievalResponseWeight)
+    return retrievalIndex
+
+
+# built at load time, or on first use for the slim load
+retrievalIndex = None
+if not slimLoad:
+    build_retrieval_index()
+
+
+def retrieve_rule(statement):
+    """ Rule number to answer an otherwise unmatched statement with, or None """
+    if retrievalIndex is None:
+        build_retrieval_index()
+    num, score = retrievalIndex.query(statement)
+    if num is not None and score >= retrievalMinScore:
+        return num
+    return None
+
+
+# --------------------------- Conversation topics -------------------------------
+# The topic rules (mother, family, ...) of a session's last topicRingSize turns are kept in one integer
+# ("topics" attribute): 7 bits per turn holding the rule number + 1, or 0 for a turn without a topic,
+# the most recent turn in the lowest bits. A topic rule also matching a statement answered by a generic
+# rule (one of topicGenericOpeners, e.g. "my (.*)") counts for the turn. While a topic is in the ring,
+# statements it matches get its follow-ups instead of such a generic rule (never instead of a specific
+# one, like the rude language rules), and unmatched statements are answered with a question about
+# it now and then. Topic rules are all of the form (.*)keyword(.*), so they are checked with substring
+# tests and one regex search for a new topic; a session without recent topics has an empty ring.
+topicContext = True
+topicRingSize = 4
+# chance (percent) of a topic follow-up where only the catch-all rule matches
+topicFollowUpChance = 50
+# keywords of the rules which are topics worth coming back to
+topicKeywords = ("friend", "sad", "depressed", "love", "birthday", "happy", "bored", "animal", "crazy",
+                 "shrink", "computer", "mother", "insecure", "father", "child", "family")
+# openers of the generic "<opener> (.*)" rules which a topic rule may stand in for
+topicGenericOpeners = ("i need", "i can't", "i am", "i'm", "what", "how", "i think", "is it", "it is", "can you",
+                       "can i", "you are", "you're", "i don't", "i feel", "i have", "i would", "is there", "my",
+                       "you", "why", "i want")
+
+TOPIC_BITS = 7
+TOPIC_MASK = (1 << TOPIC_BITS) - 1
+# topic rule -> its literal (e.g. " mother"), literal -> the first rule with it
+topicLiterals = dict((num, pattern.replace("(.*)", "")) for num, (pattern, responses) in enumerate(psychobabble)
+                     if pattern.replace("(.*)", "").strip() in topicKeywords and num < TOPIC_MASK)
+topicByLiteral = {}
+for num in sorted(topicLiterals):
+    topicByLiteral.setdefault(topicLiterals[num], num)
+# the generic rules before the last topic rule (a topic rule matching after them always matches first)
+topicGenericRules = frozenset(num for num, (pattern, responses) in enumerate(psychobabble)
+                              if num < max(topicLiterals) and
+                              pattern.replace("\\'?", "'").lower().split(" (")[0] in topicGenericOpeners)
+
+
+def literal_alternation(literals):
+    """ Regex finding the leftmost of the literals (the first listed where several start there), with
+    the literals grouped by first character so a position only tries the ones starting with its character """
+    groups = OrderedDict()
+    for literal in literals:
+        groups.setdefault(literal[0], []).append(re.escape(literal[1:]))
+    return "|".join(re.escape(first) + ("(?:" + "|".join(rests) + ")" if len(rests) > 1 else rests[0])
+                    for first, rests in groups.items())
+
+
+topicRegex = re.compile(literal_alternation([topicLiterals[num] for num in sorted(topicLiterals)]))
+
+
+def push_topic(ring, num):
+    """ The ring with the next turn added (the oldest one drops out); num is its rule, None or not a topic
+    rule for a turn without a topic """
+    entry = num + 1 if num in topicLiterals else 0
+    return ((ring << TOPIC_BITS) | entry) & ((1 << TOPIC_BITS * topicRingSize) - 1)
+
+
+def topic_match(statement, matched, ring):
+    """ (matched, or the most recent topic rule of the ring which matches statement too,
+    the topic rule of this turn or None) """
+    if matched[0] in topicLiterals:
+        # the user raised a topic just now
+        return matched, matched[0]
+    if matched[0] not in topicGenericRules:
+        # a specific rule answers (a topic rule matching the statement would have matched before a
+        # generic rule after the last topic rule)
+        return matched, None
+    mentioned = topicRegex.search(statement)
+    if mentioned is None:
+        # no topic rule matches, so none of the ring can either
+        return matched, None
+    while ring:
+        num = (ring & TOPIC_MASK) - 1
+        if num >= 0 and topicLiterals[num] in statement:
+            match = ruleTable[num].regex.match(statement.rstrip(".!"))
+            if match:
+                return (num, match.groups()), num
+        ring >>= TOPIC_BITS
+    # a topic mentioned along the way becomes the active one
+    return matched, topicByLiteral[mentioned.group()]
+
+
+def active_topic(ring):
+    """ The most recent topic rule of the ring, None if there is none """
+    while ring:
+        if ring & TOPIC_MASK:
+            return (ring & TOPIC_MASK) - 1
+        ring >>= TOPIC_BITS
+    return None
+
+
+# --------------------------- Exact phrase fast path -------------------------------
+# Most utterances are short canned phrases, so full statements (as they reach the matcher) are
+# looked up in a table built at load time from the skill's sample phrases before scanning the rules.
+# Novel statements are remembered in a bounded LRU cache. Entries always come from match_rules(),
+# so results are identical to the regex scan.
+phraseCacheSize = 2048
+
+
+# the PHRASE_TYPE sample values of the interaction model in the module docstring, kept here as data
+# so they survive python -OO and the slim load
+samplePhrases = (
+    "yes", "yes please", "no", "no thank you", "why", "why not", "no way", "where are you", "how are you",
+    "how are you today", "I am sad", "I am happy", "this is boring", "you are funny", "you are boring",
+    "it's boring", "what is the meaning of life", "I love you", "go away", "stop saying this", "I don't know",
+    "what's your name", "I like you", "the grass is green", "you are silly", "you are stupid",
+    "you know nothing", "you are smart", "I am bored", "me a joke", "can you me a joke", "can you sing",
+    "how", "where", "what", "do you like", "what do you eat", "yes I want to elaborate on this", "no I don't",
+    "I would like to tell you you more", "yes it does", "yes it does bother me", "no it doesn't",
+    "no it doesn't bother me", "nothing", "everything", "yes I am", "bad", "good", "happy", "I feel happy",
+    "I feel bad", "I feel good", "not at all", "hi mate", "who are you", "can we talk",
+    "when is your birthday", "can you laugh", "tell me a joke", "you are a joke", "I don't like you", "crazy",
+    "maybe", "shrink", "you are crazy", "speak funny", "o. k.", "how old are you", "what's up", "fantastic",
+    "amazing",
+)
+exactPhrases = {}
+phraseCache = BoundedCache(phraseCacheSize)
+
+
+def build_exact_phrases():
+    exactPhrases.clear()
+    for phrase in samplePhrases:
+        statement = prepare_statement(phrase)
+        exactPhrases[statement] = match_rules(statement)
+    phraseCache.clear()
+
+
+def find_match(statement):
+    """ Return (rule number, matched groups) of the first rule matching the statement """
+    matched = exactPhrases.get(statement)
+    if matched is None:
+        matched = phraseCache.get(statement)
+        if matched is None:
+            matched = scan_rules(statement)
+            phraseCache.put(statement, matched)
+    return matched
+
+
+# --------------------------- Compiled rules -------------------------------
+# tools/compile_rules.py turns the script into eliza_rules.py, specialized Python functions per rule.
+# It is used instead of the regexes when shipped alongside this file and compiled from the same script.
+
+def script_hash(patterns):
+    return hashlib.sha1("\n".join(patterns).encode("utf-8")).hexdigest()
+
+
+def load_compiled_rules():
+    try:
+        import eliza_rules
+    except ImportError:
+        return None
+    if eliza_rules.SCRIPT_HASH != script_hash([rule.pattern for rule in ruleTable]):
+        # compiled from a different script - ignore it
+        return None
+    return eliza_rules
+
+
+compiledRules = load_compiled_rules()
+
+
+def scan_rules(statement):
+    if compiledRules is not None:
+        matched = compiledRules.match(statement)
+        if matched is not None:
+            return matched
+    return match_rules(statement)
+
+
+# --------------------------- Locale scripts -------------------------------
+# Scripts for other markets live in localeDir as <locale>.json or <language>.json (e.g. de.json for de-DE):
+#   {"reflections": {"ich": "du", ...}, "psychobabble": [["pattern", ["response", ...]], ...]}
+# A locale's script is loaded and compiled the first time a request uses it. Locales without a script
+# (all the English ones) use the built-in script with its exact phrase, compiled rule, retrieval and
+# fuzzy stages. Loaded scripts are kept up to localeMemoryBudget bytes, least recently used ones are dropped.
+localeDir = os.path.join(os.path.dirname(os.path.abspath(__file__)), "locales")
+localeMemoryBudget = 1 << 20
+
+
+class LocaleScript(object):
+    """ The rules and reflections of one locale, matched with the plain rule loop """
+
+    def __init__(self, locale, reflections, psychobabble):
+        self.locale = locale
+        self.reflections = reflections
+        self.psychobabble = tuple((pattern, tuple(lines)) for pattern, lines in psychobabble)
+        self.rules = tuple(Rule(pattern, lines) for pattern, lines in self.psychobabble)
+        # estimate for localeMemoryBudget: the strings and containers, the rules and their regexes
+        self.size = sys.getsizeof(self.reflections) + sum(sys.getsizeof(k) + sys.getsizeof(v)
+                                                          for k, v in reflections.items()) + sum(
+            sys.getsizeof(pattern) + sum(sys.getsizeof(line) for line in lines) + 2 * sys.getsizeof(lines)
+            for pattern, lines in self.psychobabble) + sum(
+            sys.getsizeof(rule) + sys.getsizeof(rule.regex) for rule in self.rules)
+
+    def release(self):
+        """ Give up the script's share of the compiled patterns """
+        for rule in self.rules:
+            release_pattern(rule.pattern)
+
+    def prepare(self, statement):
+        """ Lower case, drop punctuation and collapse whitespace (the English rewrites don't apply) """
+        text = statement if isinstance(statement, type(u"")) else statement.decode("utf-8")
+        return " ".join(text.lower().translate(normalizeTable).split())
+
+    def match(self, statement):
+        statement = statement.rstrip(".!")
+        num = 0
+        for rule in self.rules:
+            match = rule.regex.match(statement)
+            if match:
+                return num, match.groups()
             num = num + 1
+        return None
+
+    def reflect(self, fragment):
+        tokens = fragment.lower().split()
+        for i, token in enumerate(tokens):
+            if token in self.reflections:
+                tokens[i] = self.reflections[token]
+        return ' '.join(tokens)
+
+    def analyze_ref(self, statement, attributes):
+        matched = self.match(self.prepare(statement))
+        if matched:
+            ref = response_ref(matched[0], select_line(matched[0], attributes, None, self), matched[1], self)
+            return expand_response(ref, self), ref
+        return None, None
+
+
+# locale -> LocaleScript in least recently used order, None for locales using the built-in script
+localeScripts = OrderedDict()
+localeLock = threading.Lock()
+# locales as Alexa sends them (e.g. "de-DE"); anything else never reaches the file system
+localeRegex = re.compile(r"[a-z]{2}(-[A-Z]{2})?$")
+
+
+def locale_file(locale):
+    for name in (locale, locale.split("-")[0]):
+        path = os.path.join(localeDir, name + ".json")
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def load_locale_script(locale):
+    path = locale_file(locale)
+    if path is None:
+        return None
+    with io.open(path, encoding="utf-8") as f:
+        script = json.load(f)
+    return LocaleScript(locale, script.get("reflections", {}), script["psychobabble"])
+
+
+def locale_script(locale):
+    """ The script of the request's locale, None for the built-in one """
+    if not locale or not localeRegex.match(locale):
+        return None
+    with localeLock:
+        if locale in localeScripts:
+            script = localeScripts.pop(locale)
+            localeScripts[locale] = script
+            return script
+    script = load_locale_script(locale)
+    with localeLock:
+        if locale in localeScripts:
+            # another request loaded it meanwhile - keep that one, so the patterns are shared once
+            if script is not None:
+                script.release()
+            script = localeScripts.pop(locale)
+        localeScripts[locale] = script
+        used = sum(s.size for s in localeScripts.values() if s is not None)
+        for cold in list(localeScripts):
+            if used <= localeMemoryBudget or cold == locale:
+                break
+            dropped = localeScripts.pop(cold)
+            if dropped is not None:
+                dropped.release()
+                used -= dropped.size
+    return script
+
+
+build_exact_phrases()
+
+if warmOnInit:
+    warm_up()
+
+if slimLoad:
+    __doc__ = None
@@ -0,0 +1,310 @@
+"""
+Compiled psychobabble rules - generated by tools/compile_rules.py from Eliza.py, do not edit.
+"""
+
+import re
+
+SCRIPT_HASH = 'a135216f1cb0ce08c3e780d60bb31418fe3f00f1'
+
+
+def match(s):
+    """ (rule number, groups) of the first matching rule, None if Eliza.match_rules() has to decide """
+    s = s.rstrip(".!")
+    if "\n" in s:
+        # . doesn't match new lines, leave these to the regexes
+        return None
+    # i need (.*)
+    if s.startswith('i need '):
+        return 0, (s[7:],)
+    # how are you(.*)
+    if s.startswith('how are you'):
+        return 1, (s[11:],)
+    # (.*)how old are you(.*)
+    i = s.rfind('how old are you')
+    if i >= 0:
+        return 2, (s[:i], s[i + 15:])
+    # why don\'?t you ([^\?]*)\??
+    if s.startswith("why don't you "):
+        rest = s[14:]
+        i = rest.find("?")
+        return 3, (rest if i < 0 else rest[:i],)
+    if s.startswith('why dont you '):
+        rest = s[13:]
+        i = rest.find("?")
+        return 3, (rest if i < 0 else rest[:i],)
+    # why can\'?t I ([^\?]*)\??
+    if s.startswith("why can't I "):
+        rest = s[12:]
+        i = rest.find("?")
+        return 4, (rest if i < 0 else rest[:i],)
+    if s.startswith('why cant I '):
+        rest = s[11:]
+        i = rest.find("?")
+        return 4, (rest if i < 0 else rest[:i],)
+    # i can\'?t (.*)
+    if s.startswith("i can't "):
+        return 5, (s[8:],)
+    if s.startswith('i cant '):
+        return 5, (s[7:],)
+    # i am (.*)
+    if s.startswith('i am '):
+        return 6, (s[5:],)
+    # i\'?m (.*)
+    if s.startswith("i'm "):
+        return 7, (s[4:],)
+    if s.startswith('im '):
+        return 7, (s[3:],)
+    # are you ([^\?]*)\??
+    if s.startswith('are you '):
+        rest = s[8:]
+        i = rest.find("?")
+        return 8, (rest if i < 0 else rest[:i],)
+    # what (.*)
+    if s.startswith('what '):
+        return 9, (s[5:],)
+    # how (.*)
+    if s.startswith('how '):
+        return 10, (s[4:],)
+    # because(.*)
+    if s.startswith('because'):
+        return 11, (s[7:],)
+    # (.*)sorry(.*)
+    i = s.rfind('sorry')
+    if i >= 0:
+        return 12, (s[:i], s[i + 5:])
+    # (.*)your name(.*)
+    i = s.rfind('your name')
+    if i >= 0:
+        return 13, (s[:i], s[i + 9:])
+    # (.*) friend(.*)
+    i = s.rfind(' friend')
+    if i >= 0:
+        return 14, (s[:i], s[i + 7:])
+    # (.*)my name (.*)
+    i = s.rfind('my name ')
+    if i >= 0:
+        return 15, (s[:i], s[i + 8:])
+    # (.*)eliza(.*)
+    i = s.rfind('eliza')
+    if i >= 0:
+        return 16, (s[:i], s[i + 5:])
+    # (.*)sad(.*)
+    i = s.rfind('sad')
+    if i >= 0:
+        return 17, (s[:i], s[i + 3:])
+    # (.*)depressed(.*)
+    i = s.rfind('depressed')
+    if i >= 0:
+        return 18, (s[:i], s[i + 9:])
+    # (.*)love(.*)
+    i = s.rfind('love')
+    if i >= 0:
+        return 19, (s[:i], s[i + 4:])
+    # (.*)laugh(.*)
+    i = s.rfind('laugh')
+    if i >= 0:
+        return 20, (s[:i], s[i + 5:])
+    # when is your birthday(.*)
+    if s.startswith('when is your birthday'):
+        return 21, (s[21:],)
+    # (.*)birthday(.*)
+    i = s.rfind('birthday')
+    if i >= 0:
+        return 22, (s[:i], s[i + 8:])
+    # (.*)happy(.*)
+    i = s.rfind('happy')
+    if i >= 0:
+        return 23, (s[:i], s[i + 5:])
+    # (.*)fuck you(.*)
+    i = s.rfind('fuck you')
+    if i >= 0:
+        return 24, (s[:i], s[i + 8:])
+    # (.*)fuck(.*)
+    i = s.rfind('fuck')
+    if i >= 0:
+        return 25, (s[:i], s[i + 4:])
+    # (.*)bitch(.*)
+    i = s.rfind('bitch')
+    if i >= 0:
+        return 26, (s[:i], s[i + 5:])
+    # (.*)shit(.*)
+    i = s.rfind('shit')
+    if i >= 0:
+        return 27, (s[:i], s[i + 4:])
+    # (.*)stupid(.*)
+    i = s.rfind('stupid')
+    if i >= 0:
+        return 28, (s[:i], s[i + 6:])
+    # (.*)silly(.*)
+    i = s.rfind('silly')
+    if i >= 0:
+        return 29, (s[:i], s[i + 5:])
+    # hello(.*)
+    if s.startswith('hello'):
+        return 30, (s[5:],)
+    # hi(.*)
+    if s.startswith('hi'):
+        return 31, (s[2:],)
+    # say hi(.*)
+    if s.startswith('say hi'):
+        return 32, (s[6:],)
+    # say (.*)
+    if s.startswith('say '):
+        return 33, (s[4:],)
+    # (.*) don\'t like you(.*)
+    i = s.rfind(" don't like you")
+    if i >= 0:
+        return 34, (s[:i], s[i + 15:])
+    # i think (.*)
+    if s.startswith('i think '):
+        return 35, (s[8:],)
+    # (.*) friend (.*)
+    i = s.rfind(' friend ')
+    if i >= 0:
+        return 36, (s[:i], s[i + 8:])
+    # (.*)bored(.*)
+    i = s.rfind('bored')
+    if i >= 0:
+        return 37, (s[:i], s[i + 5:])
+    # (.*)boring(.*)
+    i = s.rfind('boring')
+    if i >= 0:
+        return 38, (s[:i], s[i + 6:])
+    # yes(.*)
+    if s.startswith('yes'):
+        return 39, (s[3:],)
+    # (.*)maybe(.*)
+    i = s.rfind('maybe')
+    if i >= 0:
+        return 40, (s[:i], s[i + 5:])
+    # (.*)animal(.*)
+    i = s.rfind('animal')
+    if i >= 0:
+        return 41, (s[:i], s[i + 6:])
+    # where are you(.*)
+    if s.startswith('where are you'):
+        return 42, (s[13:],)
+    # (.*) here(.*)
+    i = s.rfind(' here')
+    if i >= 0:
+        return 43, (s[:i], s[i + 5:])
+    # (.*) crazy(.*)
+    i = s.rfind(' crazy')
+    if i >= 0:
+        return 44, (s[:i], s[i + 6:])
+    # (.*) shrink(.*)
+    i = s.rfind(' shrink')
+    if i >= 0:
+        return 45, (s[:i], s[i + 7:])
+    # (.*)no reason(.*)
+    i = s.rfind('no reason')
+    if i >= 0:
+        return 46, (s[:i], s[i + 9:])
+    # (.*)interesting(.*)
+    i = s.rfind('interesting')
+    if i >= 0:
+        return 47, (s[:i], s[i + 11:])
+    # nothing(.*)
+    if s.startswith('nothing'):
+        return 48, (s[7:],)
+    # no(.*)
+    if s.startswith('no'):
+        return 49, (s[2:],)
+    # (.*) computer(.*)
+    i = s.rfind(' computer')
+    if i >= 0:
+        return 50, (s[:i], s[i + 9:])
+    # is it (.*)
+    if s.startswith('is it '):
+        return 51, (s[6:],)
+    # it is (.*)
+    if s.startswith('it is '):
+        return 52, (s[6:],)
+    # can you ([^\?]*)\??
+    if s.startswith('can you '):
+        rest = s[8:]
+        i = rest.find("?")
+        return 53, (rest if i < 0 else rest[:i],)
+    # can I ([^\?]*)\??
+    if s.startswith('can I '):
+        rest = s[6:]
+        i = rest.find("?")
+        return 54, (rest if i < 0 else rest[:i],)
+    # you are (.*)
+    if s.startswith('you are '):
+        return 55, (s[8:],)
+    # you\'?re (.*)
+    if s.startswith("you're "):
+        return 56, (s[7:],)
+    if s.startswith('youre '):
+        return 56, (s[6:],)
+    # i don\'?t (.*)
+    if s.startswith("i don't "):
+        return 57, (s[8:],)
+    if s.startswith('i dont '):
+        return 57, (s[7:],)
+    # i feel (.*)
+    if s.startswith('i feel '):
+        return 58, (s[7:],)
+    # i have (.*)
+    if s.startswith('i have '):
+        return 59, (s[7:],)
+    # i would (.*)
+    if s.startswith('i would '):
+        return 60, (s[8:],)
+    # is there (.*)
+    if s.startswith('is there '):
+        return 61, (s[9:],)
+    # my (.*)
+    if s.startswith('my '):
+        return 62, (s[3:],)
+    # you (.*)
+    if s.startswith('you '):
+        return 63, (s[4:],)
+    # why (.*)
+    if s.startswith('why '):
+        return 64, (s[4:],)
+    # i want (.*)
+    if s.startswith('i want '):
+        return 65, (s[7:],)
+    # (.*) mother(.*)
+    i = s.rfind(' mother')
+    if i >= 0:
+        return 66, (s[:i], s[i + 7:])
+    # (.*) insecure(.*)
+    i = s.rfind(' insecure')
+    if i >= 0:
+        return 67, (s[:i], s[i + 9:])
+    # (.*) joke(.*)
+    i = s.rfind(' joke')
+    if i >= 0:
+        return 68, (s[:i], s[i + 5:])
+    # (.*) father(.*)
+    i = s.rfind(' father')
+    if i >= 0:
+        return 69, (s[:i], s[i + 7:])
+    # (.*) child(.*)
+    i = s.rfind(' child')
+    if i >= 0:
+        return 70, (s[:i], s[i + 6:])
+    # (.*) family(.*)
+    i = s.rfind(' family')
+    if i >= 0:
+        return 71, (s[:i], s[i + 7:])
+    # (.*) like(.*)
+    i = s.rfind(' like')
+    if i >= 0:
+        return 72, (s[:i], s[i + 5:])
+    # speak funny
+    if s.startswith('speak funny'):
+        return 73, ()
+    # (.*)\?
+    i = s.rfind("?")
+    if i >= 0:
+        return 74, (s[:i],)
+    # quit
+    if s.startswith('quit'):
+        return 75, ()
+    # (.*)
+    return 76, (s,)
+    return None
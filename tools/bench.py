@@ -0,0 +1,451 @@
+"""
+Micro benchmarks for the local Eliza engine.
+Runs offline, no AWS needed:
+
+    python tools/bench.py              # all benchmarks
+    python tools/bench.py normalize    # only the named ones
+"""
+
+from __future__ import print_function
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Eliza
+
+# typical Alexa transcription variants of things the script has specific rules for
+asrVariants = [
+    "I do not like you",
+    "I can not sleep",
+    "i cannot stop",
+    "O. K.",
+    "okay, I am 5",
+    "i wanna go home",
+    "why do not you listen",
+    "I do not know",
+    "well,   I am happy!",
+    "cos I said so",
+]
+
+benchmarks = []
+
+
+def benchmark(fn):
+    benchmarks.append(fn)
+    return fn
+
+
+def sample_phrases():
+    return list(Eliza.samplePhrases)
+
+
+def measure(fn, items, repeat=5):
+    """ Best per-item time of fn over items in microseconds """
+    def run():
+        for item in items:
+            fn(item)
+    number = max(1, 2000 // max(len(items), 1))
+    best = min(timeit.repeat(run, number=number, repeat=repeat))
+    return best / (number * len(items)) * 1e6
+
+
+def report(name, micros, note=""):
+    print("%-32s %10.2f us  %s" % (name, micros, note))
+
+
+def rules_scanned(statement):
+    matched = Eliza.match_rules(statement)
+    return matched[0] + 1 if matched else len(Eliza.psychobabble)
+
+
+@benchmark
+def normalize():
+    phrases = sample_phrases() + asrVariants
+
+    def cold(statement):
+        Eliza.normalizeCache.clear()
+        Eliza.normalize_input(statement)
+    report("normalize (uncached)", measure(cold, phrases))
+    report("normalize (cached)", measure(Eliza.normalize_input, phrases))
+    report("match_rules (sample phrases)", measure(Eliza.match_rules, [Eliza.normalize_input(p) for p in phrases]))
+
+    raw = [v.lower() for v in asrVariants]
+    normalized = [Eliza.normalize_input(v) for v in asrVariants]
+    fixed = sum(1 for r, n in zip(raw, normalized) if Eliza.match_rules(r)[0] != Eliza.match_rules(n)[0])
+    scannedRaw = sum(rules_scanned(r) for r in raw)
+    scannedNormalized = sum(rules_scanned(n) for n in normalized)
+    report("ASR variants: match raw", measure(Eliza.match_rules, raw))
+    report("ASR variants: normalize + match", measure(lambda v: Eliza.match_rules(Eliza.normalize_input(v)), asrVariants),
+           "%d/%d hit a more specific rule, rules scanned %d -> %d" %
+           (fixed, len(asrVariants), scannedRaw, scannedNormalized))
+
+
+@benchmark
+def exact_phrases():
+    phrases = [Eliza.prepare_statement(p) for p in sample_phrases()]
+    novel = [Eliza.prepare_statement(p) for p in asrVariants]
+    mismatches = sum(1 for p in phrases + novel if Eliza.find_match(p) != Eliza.match_rules(p))
+    print("%d exact phrases, %d mismatches against match_rules" % (len(Eliza.exactPhrases), mismatches))
+    report("match_rules (sample phrases)", measure(Eliza.match_rules, phrases))
+    report("find_match (sample phrases)", measure(Eliza.find_match, phrases), "exact phrase table")
+    report("match_rules (novel phrases)", measure(Eliza.match_rules, novel))
+    report("find_match (novel, cached)", measure(Eliza.find_match, novel), "LRU cache")
+
+    def cold(statement):
+        Eliza.phraseCache.clear()
+        Eliza.find_match(statement)
+    report("find_match (novel, uncached)", measure(cold, novel))
+
+
+@benchmark
+def compiled_rules():
+    if Eliza.compiledRules is None:
+        print("eliza_rules.py missing or out of date - run tools/compile_rules.py")
+        return
+    phrases = [Eliza.prepare_statement(p) for p in sample_phrases() + asrVariants]
+    catchAll = ["the grass is green and the sky is blue", "something completely different"]
+    report("match_rules (phrases)", measure(Eliza.match_rules, phrases), "interpreted regexes")
+    report("compiled match (phrases)", measure(Eliza.compiledRules.match, phrases), "eliza_rules.py")
+    report("match_rules (catch-all)", measure(Eliza.match_rules, catchAll), "all rules scanned")
+    report("compiled match (catch-all)", measure(Eliza.compiledRules.match, catchAll))
+
+
+def session_after(turns):
+    """ Session attributes after a number of local turns over the sample phrases """
+    attributes = {}
+    Eliza.initialise_attributes(attributes)
+    phrases = sample_phrases()
+    for n in range(turns):
+        message, ref = Eliza.analyze_ref(phrases[n % len(phrases)], attributes)
+        attributes["lastRsp"] = ref
+    return attributes
+
+
+@benchmark
+def session_codec():
+    import json
+    for turns in (1, 10, 50):
+        attributes = session_after(turns)
+        packed = Eliza.encode_session_attributes(attributes)
+        plain = json.dumps(attributes)
+        print("%d turns: %d bytes as JSON, %d bytes packed" % (turns, len(plain), len(json.dumps(packed))))
+        report("  encode", measure(Eliza.encode_session_attributes, [attributes]))
+        report("  decode", measure(Eliza.decode_session_attributes, [packed]))
+        report("  json round trip (plain)", measure(lambda a: json.loads(json.dumps(a)), [attributes]))
+        report("  json round trip (packed)", measure(lambda a: json.loads(json.dumps(a)), [packed]))
+
+
+def turn_event(phrase, attributes):
+    """ A TellEliza IntentRequest event as sent by Alexa """
+    return {"session": {"new": False, "sessionId": "SessionId.bench", "attributes": attributes,
+                        "application": {"applicationId": "amzn1.ask.skill.df26fd2c-e0bc-47a3-8553-49023a8a67b7"},
+                        "user": {"userId": "amzn1.ask.account.bench"}},
+            "request": {"type": "IntentRequest", "requestId": "EdwRequestId.bench", "locale": "en-US",
+                        "timestamp": "2021-01-01T00:00:00Z",
+                        "intent": {"name": "TellEliza", "slots": {"Phrase": {"name": "Phrase", "value": phrase}}}},
+            "context": {"System": {}}}
+
+
+benchSession = []
+
+
+def handler_turn(phrase):
+    """ One full turn through lambda_handler, continuing a session of a few turns """
+    if not benchSession:
+        attributes = session_after(5)
+        benchSession.append(Eliza.encode_session_attributes(attributes) if Eliza.sessionCodec else attributes)
+    return Eliza.lambda_handler(turn_event(phrase, benchSession[0]), None)
+
+
+@benchmark
+def profiling():
+    phrases = sample_phrases()
+    saved = Eliza.profiling
+    Eliza.profiling = False
+    report("lambda_handler (profiling off)", measure(handler_turn, phrases))
+    Eliza.profiling = True
+    report("lambda_handler (not triggered)", measure(handler_turn, phrases))
+    Eliza.profiling = saved
+
+
+# statements only the generic (.*) rule matches
+catchAllPhrases = [
+    "the grass is green",
+    "we both apologize",
+    "psychiatrist visits cost money",
+    "the reason escapes us",
+    "those were childhood traumas",
+    "an elephant at the zoo",
+    "robots and machines",
+    "that was hilarious",
+]
+
+
+# catch-all statements and the patterns of the rules which may answer them (None: only the catch-all lines)
+retrievalLabelled = [
+    ("we both apologize", ["(.*)sorry(.*)"]),
+    ("i apologize", ["(.*)sorry(.*)"]),
+    ("psychiatrist visits cost money", ["(.*) shrink(.*)"]),
+    ("the reason escapes us", ["because(.*)", "(.*)no reason(.*)"]),
+    ("the medicines help", ["(.*)depressed(.*)"]),
+    ("cheer me up", ["(.*)sad(.*)", "(.*)depressed(.*)"]),
+    ("feelings are complicated", ["i feel (.*)"]),
+    ("names mean a lot", ["(.*)my name (.*)"]),
+    ("nightmares keep me awake", ["(.*) child(.*)"]),
+    ("cats are cute", ["(.*)animal(.*)"]),
+    ("a relationship needs work", ["(.*) mother(.*)", "(.*) father(.*)"]),
+    ("the weather is nice", None),
+    ("tell me something", None),
+    ("the grass is green", None),
+    ("an elephant at the zoo", None),
+    ("the bus was late again", None),
+    ("we went to the beach", None),
+    ("that was hilarious", None),
+    ("cloudy with a chance of rain", None),
+    ("the zombies are coming", None),
+    ("robots and machines", None),
+    ("the train leaves at noon", None),
+    ("something happened at school", None),
+    ("the question is simple", None),
+    ("a chance of winning", None),
+    ("we painted the kitchen", None),
+    ("there was traffic", None),
+]
+
+
+def retrieval_results(minScore):
+    """ (rules retrieved as labelled, unlabelled rules retrieved) over retrievalLabelled """
+    right = wrong = 0
+    for phrase, patterns in retrievalLabelled:
+        num, score = Eliza.retrievalIndex.query(Eliza.prepare_statement(phrase))
+        if num is not None and score >= minScore:
+            if patterns is not None and Eliza.psychobabble[num][0] in patterns:
+                right += 1
+            else:
+                wrong += 1
+    return right, wrong
+
+
+@benchmark
+def retrieval():
+    statements = [Eliza.prepare_statement(p) for p in catchAllPhrases]
+    Eliza.retrieve_rule(statements[0])
+    try:
+        import numpy
+    except ImportError:
+        numpy = None
+    print("index: %d rules, %d terms, numpy %s" %
+          (len(Eliza.retrievalIndex.rules), len(Eliza.retrievalIndex.terms), "yes" if numpy is not None else "no"))
+    labelled = sum(1 for phrase, patterns in retrievalLabelled if patterns is not None)
+    for minScore in (0.2, 0.25, 0.3, 0.35, 0.4, 0.5):
+        right, wrong = retrieval_results(minScore)
+        print("retrievalMinScore %.2f: %d/%d labelled rules retrieved, %d unrelated%s" %
+              (minScore, right, labelled, wrong, "  (current)" if minScore == Eliza.retrievalMinScore else ""))
+    attributes = session_after(0)
+    saved = Eliza.retrievalFallback
+    Eliza.retrievalFallback = False
+    report("analyze (catch-all)", measure(lambda p: Eliza.analyze(p, attributes), catchAllPhrases))
+    Eliza.retrievalFallback = True
+    report("analyze (retrieval fallback)", measure(lambda p: Eliza.analyze(p, attributes), catchAllPhrases))
+    Eliza.retrievalFallback = saved
+    report("retrieve_rule", measure(Eliza.retrieve_rule, statements))
+    batch = statements * 125
+    report("query_batch (per statement)", measure(Eliza.retrievalIndex.query_batch, [batch], repeat=3) / len(batch),
+           "%d statements per batch" % len(batch))
+
+
+# misrecognized transcriptions of keywords the script has rules for
+asrErrors = [
+    "my mothr is nice",
+    "tell me about my fam ily",
+    "my fathr hates me",
+    "i am depresed",
+    "my chidl cries",
+    "you are stupdi",
+]
+
+# real words close to a keyword, which must be left alone
+realWords = [
+    "the station is farther than i thought",
+    "we fried some eggs",
+    "the theme of the party was pirates",
+    "my jumper shrank in the wash",
+    "a lorry blocked the road",
+    "can you compute this",
+    "the staff were friendly",
+]
+
+
+@benchmark
+def fuzzy():
+    phrases = [Eliza.normalize_input(p) for p in sample_phrases() + asrErrors]
+    started = timeit.default_timer()
+    index = Eliza.build_fuzzy_index()
+    built = (timeit.default_timer() - started) * 1e3
+    size = sum(sys.getsizeof(v) for v in index.grams.values()) + sys.getsizeof(index.grams) + \
+        sys.getsizeof(index.knownWords) + sys.getsizeof(index.keywords)
+    print("index: %d keywords, %d known words, %d trigrams, ~%d KB, built in %.1f ms" %
+          (len(index.keywords), len(index.knownWords), len(index.grams), size // 1024, built))
+
+    Eliza.fuzzyMatching = False
+    report("fuzzy_correct (disabled)", measure(Eliza.fuzzy_correct, phrases))
+    Eliza.fuzzyMatching = True
+
+    def cold(statement):
+        Eliza.fuzzyCache.clear()
+        Eliza.fuzzy_correct(statement)
+    report("fuzzy_correct (uncached)", measure(cold, phrases))
+    report("fuzzy_correct (cached)", measure(Eliza.fuzzy_correct, phrases))
+
+    def corrected(phrase):
+        # as analyze_ref() does: only statements a generic or the catch-all rule matches
+        statement = Eliza.prepare_statement(phrase)
+        matched = Eliza.find_match(statement)
+        return (matched[0] == Eliza.catchAllRule or matched[0] in Eliza.topicGenericRules) and \
+            Eliza.fuzzy_match(statement, matched)[0] != statement
+    fixed = sum(1 for p in asrErrors if corrected(p))
+    changed = [p for p in realWords if corrected(p)]
+    Eliza.fuzzyMatching = False
+    print("%d/%d misrecognized phrases corrected, %d/%d statements with real words changed %s" %
+          (fixed, len(asrErrors), len(changed), len(realWords), changed))
+
+
+@benchmark
+def transcript():
+    import tempfile
+    phrases = sample_phrases()
+    path = os.path.join(tempfile.mkdtemp(), "bench.transcript")
+    writer = Eliza.TranscriptWriter(path)
+    report("record (queue only)", measure(lambda p: writer.record("BENCH001", 1, p, 3, 1, 250, "en-US"), phrases))
+    started = timeit.default_timer()
+    writer.flush()
+    written = writer.count
+    report("flush (per record)", (timeit.default_timer() - started) * 1e6 / max(written, 1), "%d records" % written)
+    writer.close()
+    started = timeit.default_timer()
+    count = sum(1 for record in Eliza.read_transcript(path))
+    report("read_transcript (per record)", (timeit.default_timer() - started) * 1e6 / max(count, 1),
+           "%d KB file" % (os.path.getsize(path) // 1024))
+
+    saved = Eliza.transcriptWriter
+    Eliza.transcriptWriter = None
+    report("lambda_handler (transcript off)", measure(handler_turn, phrases))
+    Eliza.transcriptWriter = Eliza.TranscriptWriter(path)
+    report("lambda_handler (transcript on)", measure(handler_turn, phrases))
+    Eliza.transcriptWriter.close()
+    Eliza.transcriptWriter = saved
+    os.remove(path)
+
+
+@benchmark
+def admission():
+    users = ["amzn1.ask.account.%06d" % n for n in range(50000)]
+    buckets = Eliza.TokenBuckets(Eliza.userRate, Eliza.userBurst, Eliza.admissionMaxUsers)
+    now = timeit.default_timer()
+    report("take (50000 users)", measure(lambda u: buckets.take(u, now), users, repeat=3),
+           "%d buckets kept" % len(buckets))
+    report("take (one user, empty bucket)", measure(lambda u: buckets.take(u, now), users[:1]))
+
+    phrases = sample_phrases()
+    saved = Eliza.admissionControl, Eliza.userBuckets, Eliza.globalBucket
+    Eliza.admissionControl = False
+    report("lambda_handler (admission off)", measure(handler_turn, phrases))
+    Eliza.admissionControl = True
+    Eliza.userBuckets = Eliza.TokenBuckets(1e9, 1e9, 1)
+    Eliza.globalBucket = Eliza.TokenBuckets(1e9, 1e9, 1)
+    report("lambda_handler (admitted)", measure(handler_turn, phrases))
+    Eliza.userBuckets = Eliza.TokenBuckets(1e-9, 1, 1)
+    report("lambda_handler (shed)", measure(handler_turn, phrases))
+    Eliza.admissionControl, Eliza.userBuckets, Eliza.globalBucket = saved
+
+
+# statements for the German script (locales/de.json)
+germanPhrases = [
+    u"ich bin sehr traurig",
+    u"ich kann nicht schlafen",
+    u"meine mutter hasst mich",
+    u"kannst du mir helfen",
+    u"das wetter ist sch\u00f6n",
+    u"warum sagst du das",
+]
+
+
+@benchmark
+def locales():
+    Eliza.localeScripts.clear()
+    started = timeit.default_timer()
+    script = Eliza.locale_script("de-DE")
+    loaded = (timeit.default_timer() - started) * 1e3
+    print("de-DE: %d rules loaded in %.1f ms, ~%d KB, %d regexes shared with the built-in script" %
+          (len(script.rules), loaded, script.size // 1024,
+           sum(1 for rule in script.rules if rule.regex in set(r.regex for r in Eliza.ruleTable))))
+    report("locale_script (cached)", measure(Eliza.locale_script, ["de-DE", "en-US"]))
+    attributes = session_after(0)
+    report("analyze (built-in, en-US)", measure(lambda p: Eliza.analyze(p, attributes), sample_phrases()))
+    report("analyze (de-DE)", measure(lambda p: Eliza.analyze_ref(p, attributes, script), germanPhrases))
+
+
+# a conversation coming back to a topic
+topicPhrases = [
+    "my mother hates me",
+    "i need my mother to listen",
+    "i do not know",
+    "she never calls",
+    "i need a break",
+    "whatever",
+]
+# specific rules which must keep answering while a topic (family) is active
+topicSpecificPhrases = [
+    "fuck my family",
+    "my family is shit",
+    "you are a bitch like my family",
+]
+
+
+@benchmark
+def topics():
+    saved = Eliza.topicContext
+    ring = 0
+    for num in (66, 0, 76, 62):
+        ring = Eliza.push_topic(ring, num)
+    report("push_topic", measure(lambda num: Eliza.push_topic(ring, num), [0, 66, 76]))
+    report("active_topic", measure(Eliza.active_topic, [ring, 0]))
+    statements = [(Eliza.prepare_statement(p), Eliza.find_match(Eliza.prepare_statement(p))) for p in topicPhrases]
+    report("topic_match", measure(lambda s: Eliza.topic_match(s[0], s[1], ring), statements))
+
+    attributes = session_after(0)
+    phrases = sample_phrases() + topicPhrases
+    for enabled in (False, True):
+        Eliza.topicContext = enabled
+        report("analyze (topics %s)" % ("on" if enabled else "off"),
+               measure(lambda p: Eliza.analyze(p, attributes), phrases))
+    # interleaved rounds, so both settings see the same machine load
+    best = {}
+    for round in range(5):
+        for enabled in (False, True):
+            Eliza.topicContext = enabled
+            micros = measure(handler_turn, phrases, repeat=1)
+            best[enabled] = min(best.get(enabled, micros), micros)
+    for enabled in (False, True):
+        report("lambda_handler (topics %s)" % ("on" if enabled else "off"), best[enabled])
+
+    Eliza.topicContext = True
+    kept = 0
+    for phrase in topicSpecificPhrases:
+        attributes = session_after(0)
+        Eliza.analyze("tell me about my family", attributes)
+        kept += Eliza.analyze_ref(phrase, attributes)[1][0] == Eliza.find_match(Eliza.prepare_statement(phrase))[0]
+    Eliza.topicContext = saved
+    print("%d/%d statements of specific rules kept their rule with a topic active" % (kept, len(topicSpecificPhrases)))
+
+
+def main(names):
+    for fn in benchmarks:
+        if not names or fn.__name__ in names:
+            print("--- " + fn.__name__)
+            fn()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,123 @@
+"""
+Round trip and compatibility checks of the session attributes codec (see sessionCodec in Eliza.py).
+Runs offline in a second:
+
+    python tools/codec_check.py
+
+Sessions of different lengths are packed and unpacked again, and the decoder has to keep accepting
+what older and newer releases send: plain dict attributes, packed state without the fields added
+later, fields with unknown tags and a newer format version (the session restarts), and a stored
+line reference the script no longer has (repeated as a catch-all line). Failed checks are printed
+and the script exits with 1.
+"""
+
+from __future__ import print_function
+import base64
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, ".."))
+import Eliza
+import bench
+
+failures = []
+
+
+def check(name, ok):
+    if not ok:
+        failures.append(name)
+        print("FAILED: " + name)
+
+
+def pack(version, fields):
+    """ Packed state of the given version made of (tag, field) pairs, without zlib """
+    payload = bytearray()
+    for tag, field in fields:
+        Eliza.put_field(payload, tag, field)
+    packed = bytearray([version, 0]) + payload
+    return {Eliza.sessionStateKey: base64.b64encode(bytes(packed)).decode("ascii")}
+
+
+def same_session(attributes, decoded):
+    """ attributes == decoded, up to the order and repeats of the used lines (stored as bitsets)
+    and the empty topic ring (the default, not stored) """
+    def normal(a):
+        a = dict(a)
+        a["used"] = [sorted(set(lines)) for lines in a.get("used", [])]
+        a.setdefault("topics", 0)
+        return a
+    return normal(attributes) == normal(decoded)
+
+
+def round_trip(attributes):
+    return same_session(attributes, Eliza.decode_session_attributes(Eliza.encode_session_attributes(attributes)))
+
+
+def round_trips():
+    for turns in (0, 1, 10, 50):
+        check("round trip after %d turns" % turns, round_trip(bench.session_after(turns)))
+    attributes = bench.session_after(3)
+    attributes["lastRsp"] = u"Why do you say that your mother is \u00fcberall?"
+    attributes["topics"] = Eliza.push_topic(Eliza.push_topic(0, min(Eliza.topicLiterals)), None)
+    attributes["custom"] = {"nested": [1, 2, u"x"]}
+    check("round trip of text, topics and other attributes", round_trip(attributes))
+
+
+def compatibility():
+    plain = bench.session_after(2)
+    check("plain dict attributes are returned as they are", Eliza.decode_session_attributes(plain) is plain)
+
+    sessionId = bytearray()
+    Eliza.put_string(sessionId, "ABCD1234")
+    lastRsp = bytearray()
+    for value in (3, 1, 0):
+        Eliza.put_varint(lastRsp, value)
+    # the first release of the format had no turn and topics fields
+    decoded = Eliza.decode_session_attributes(pack(1, [(Eliza.TAG_SESSION_ID, sessionId),
+                                                       (Eliza.TAG_LAST_REF, lastRsp),
+                                                       (Eliza.TAG_USED, Eliza.encode_used([[], [2]]))]))
+    used = [[], [2]] + [[] for i in range(len(Eliza.psychobabble) - 2)]
+    check("state without the later fields", decoded == {"chatbotSessionId": "ABCD1234", "lastRsp": [3, 1],
+                                                        "used": used})
+
+    unknown = bytearray(b"from a newer release")
+    decoded = Eliza.decode_session_attributes(pack(1, [(Eliza.TAG_SESSION_ID, sessionId), (13, unknown)]))
+    check("fields with unknown tags are skipped", decoded == {"chatbotSessionId": "ABCD1234"})
+
+    newer = pack(Eliza.sessionCodecVersion + 1, [(Eliza.TAG_SESSION_ID, sessionId)])
+    check("a newer format version restarts the session", Eliza.decode_session_attributes(newer) == {})
+    response = Eliza.lambda_handler(bench.turn_event("i need a holiday", dict(newer)), None)
+    attributes = Eliza.decode_session_attributes(response["sessionAttributes"])
+    check("a turn with a newer format version is answered in a new session",
+          response["response"]["outputSpeech"]["ssml"] != "<speak></speak>" and
+          attributes["chatbotSessionId"] != "ABCD1234" and "lastRsp" in attributes)
+
+    # sessions started before a deploy which changed the script keep references to its old lines
+    catchAll = Eliza.psychobabble[-1][1][0]
+    for ref, expected in (([6, 0, u"sad"], u"Did you come to me because you are sad?"), ([77, 0], catchAll),
+                          ([6, 9], catchAll), ([6, 0], catchAll), ([76, 0, u"x"], catchAll)):
+        attributes = bench.session_after(1)
+        attributes["lastRsp"] = ref
+        event = bench.turn_event("", Eliza.encode_session_attributes(attributes))
+        event["request"]["intent"] = {"name": "AMAZON.RepeatIntent", "slots": {}}
+        response = Eliza.lambda_handler(event, None)
+        check("repeating the reference %r" % ref, response["response"]["outputSpeech"]["ssml"] ==
+              "<speak>" + expected + "</speak>")
+
+
+def main():
+    saved = Eliza.sessionCodec
+    # responses are checked with the codec off (the default) and on
+    for enabled in (False, True):
+        Eliza.sessionCodec = enabled
+        round_trips()
+        compatibility()
+    Eliza.sessionCodec = saved
+    print("%d check(s) failed" % len(failures) if failures else "all codec checks passed")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
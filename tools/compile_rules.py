@@ -0,0 +1,148 @@
+"""
+Compiles the psychobabble script of Eliza.py into a Python module of specialized match functions.
+
+    python tools/compile_rules.py             # writes eliza_rules.py next to Eliza.py
+
+Each rule becomes a block of match() using str.startswith/rfind/find where the pattern allows it
+(regexes only where needed), in script order. The result is the same as Eliza.match_rules();
+Eliza loads the module when present and its SCRIPT_HASH matches the script.
+Run again after changing the script.
+"""
+
+from __future__ import print_function
+import os
+import re
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+import Eliza
+
+outputFile = os.path.join(here, "..", "eliza_rules.py")
+
+# a pattern fragment without any regex syntax (escaped apostrophes are allowed)
+literal = r"(?:[^.^$*+?{}\[\]\\|()]|\\')+"
+# an apostrophe the pattern makes optional, e.g. don\'?t
+optionalApostrophe = "\\'?"
+
+
+def literal_variants(fragment):
+    """ All strings a literal fragment matches ("don\\'?t" -> "don't", "dont") or None if it isn't literal """
+    parts = fragment.split(optionalApostrophe)
+    if not all(re.match("^" + literal + "$", part) or part == "" for part in parts) or len(parts) > 3:
+        return None
+    variants = [parts[0].replace("\\'", "'")]
+    for part in parts[1:]:
+        part = part.replace("\\'", "'")
+        variants = [v + "'" + part for v in variants] + [v + part for v in variants]
+    return variants
+
+
+def compile_rule(num, pattern):
+    """ Source lines of the function for one rule, returning the groups tuple or None """
+    lines = ["def rule_%d(s):" % num, "    # %s" % pattern]
+
+    # (.*) - everything
+    if pattern == "(.*)":
+        lines.append("    return (s,)")
+        return lines
+
+    # (.*)\? - up to the last question mark
+    if pattern == "(.*)\\?":
+        lines += ["    i = s.rfind(\"?\")",
+                  "    if i >= 0:",
+                  "        return (s[:i],)",
+                  "    return None"]
+        return lines
+
+    # literal(.*) / literal ([^\?]*)\?? / literal
+    m = re.match(r"^(.*?)(\(\.\*\)|\(\[\^\\\?\]\*\)\\\?\?)?$", pattern)
+    variants = literal_variants(m.group(1)) if m else None
+    if variants:
+        group = m.group(2)
+        for variant in variants:
+            lines.append("    if s.startswith(%r):" % variant)
+            if group is None:
+                lines.append("        return ()")
+            elif group == "(.*)":
+                lines.append("        return (s[%d:],)" % len(variant))
+            else:
+                # ([^\?]*) stops at the first question mark
+                lines += ["        rest = s[%d:]" % len(variant),
+                          "        i = rest.find(\"?\")",
+                          "        return (rest if i < 0 else rest[:i],)"]
+        lines.append("    return None")
+        return lines
+
+    # (.*)literal(.*) - greedy, so the last occurrence of the literal
+    m = re.match(r"^\(\.\*\)(.*)\(\.\*\)$", pattern)
+    variants = literal_variants(m.group(1)) if m else None
+    if variants and len(variants) == 1:
+        lines += ["    i = s.rfind(%r)" % variants[0],
+                  "    if i >= 0:",
+                  "        return (s[:i], s[i + %d:])" % len(variants[0]),
+                  "    return None"]
+        return lines
+
+    # anything else stays a regex
+    lines[0:0] = ["_regex_%d = re.compile(%r)" % (num, pattern), ""]
+    lines += ["    match = _regex_%d.match(s)" % num,
+              "    if match:",
+              "        return match.groups()",
+              "    return None"]
+    return lines
+
+
+def inline_rule(num, lines):
+    """ Body of a rule function as a block of match(): returns the rule number too and falls through on no match """
+    block = []
+    for line in lines:
+        if line.startswith("def ") or line.startswith("_regex_") or not line or line == "    return None":
+            continue
+        block.append(re.sub(r"return (.*)$", r"return %d, \1" % num, line))
+    return block
+
+
+def generate(psychobabble):
+    """ Source of the compiled rules module """
+    patterns = [pattern for pattern, responses in psychobabble]
+    out = ['"""',
+           "Compiled psychobabble rules - generated by tools/compile_rules.py from Eliza.py, do not edit.",
+           '"""',
+           "",
+           "import re",
+           "",
+           "SCRIPT_HASH = %r" % Eliza.script_hash(patterns)]
+    # the tests of all rules are inlined in match(), only the regexes of the rules which need one are kept apart
+    regexes = [line for num, pattern in enumerate(patterns) for line in compile_rule(num, pattern)
+               if line.startswith("_regex_")]
+    out += ([""] + regexes if regexes else []) + [
+            "",
+            "",
+            "def match(s):",
+            "    \"\"\" (rule number, groups) of the first matching rule, None if Eliza.match_rules() has to decide \"\"\"",
+            "    s = s.rstrip(\".!\")",
+            "    if \"\\n\" in s:",
+            "        # . doesn't match new lines, leave these to the regexes",
+            "        return None"]
+    for num, pattern in enumerate(patterns):
+        out += inline_rule(num, compile_rule(num, pattern))
+    out += ["    return None", ""]
+    return "\n".join(out)
+
+
+def specialized_count(psychobabble):
+    return sum(1 for num, (pattern, responses) in enumerate(psychobabble)
+               if "re.compile" not in "\n".join(compile_rule(num, pattern)))
+
+
+def main(args):
+    target = args[0] if args else outputFile
+    with open(target, "w") as f:
+        f.write(generate(Eliza.psychobabble))
+    print("wrote %s: %d rules, %d without regexes" %
+          (target, len(Eliza.psychobabble), specialized_count(Eliza.psychobabble)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
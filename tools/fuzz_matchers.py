@@ -0,0 +1,140 @@
+"""
+Differential fuzzing of the optimized matchers against the original sequential re.match loop.
+Runs offline in a few seconds:
+
+    python tools/fuzz_matchers.py                  # 20000 utterances, seed 1
+    python tools/fuzz_matchers.py --count 100000 --seed 7
+
+Utterances are random strings and grammar based ones built from the rule literals, the reflections
+vocabulary and the PHRASE_TYPE samples. Every matcher has to return the same rule number and groups
+as the reference; mismatches are shrunk to a minimal counterexample and the script exits with 1.
+"""
+
+from __future__ import print_function
+import os
+import random
+import re
+import sys
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, here)
+sys.path.insert(0, os.path.join(here, ".."))
+import Eliza
+import compile_rules
+
+alphabet = "abcdefghijklmnopqrstuvwxyz     '?.!,\n"
+punctuation = ["", "", "", "?", ".", "!", "...", " ?", "?!"]
+
+
+def reference_match(statement):
+    """ The original analyze() loop """
+    num = 0
+    for pattern, responses in Eliza.psychobabble:
+        match = re.match(pattern, statement.rstrip(".!"))
+        if match:
+            return num, match.groups()
+        num = num + 1
+    return None
+
+
+def load_generated():
+    """ Freshly generated rules module, so a stale eliza_rules.py can't hide a compiler bug """
+    namespace = {}
+    exec(compile(compile_rules.generate(Eliza.psychobabble), "<generated rules>", "exec"), namespace)
+    return namespace["match"]
+
+
+def matchers():
+    generated = load_generated()
+    paths = [("match_rules", Eliza.match_rules),
+             ("generated rules", lambda s: generated(s) or Eliza.match_rules(s)),
+             ("find_match", Eliza.find_match)]
+    if Eliza.compiledRules is not None:
+        paths.append(("eliza_rules.py", lambda s: Eliza.compiledRules.match(s) or Eliza.match_rules(s)))
+    return paths
+
+
+def vocabulary():
+    words = set(Eliza.reflections) | set(" ".join(Eliza.reflections.values()).split())
+    literals = []
+    for pattern, responses in Eliza.psychobabble:
+        fragment = re.sub(r"\([^)]*\)|\\\??|\?", "|", pattern.replace("\\'?", "'"))
+        for part in fragment.split("|"):
+            if part.strip():
+                literals.append(part)
+                words.update(part.split())
+    for phrase in Eliza.samplePhrases:
+        words.update(phrase.lower().split())
+    return sorted(words), literals
+
+
+def utterances(count, rng):
+    """ Mix of sample phrases, grammar based and random utterances """
+    words, literals = vocabulary()
+    samples = [p.lower() for p in Eliza.samplePhrases]
+    for n in range(count):
+        kind = n % 5
+        if kind == 0:
+            s = "".join(rng.choice(alphabet) for _ in range(rng.randint(0, 20)))
+        elif kind == 1:
+            s = rng.choice(samples) + rng.choice(punctuation)
+        elif kind == 2:
+            s = rng.choice(literals) + " ".join(rng.choice(words) for _ in range(rng.randint(0, 5)))
+        elif kind == 3:
+            parts = [rng.choice(words) for _ in range(rng.randint(0, 4))]
+            parts.insert(rng.randint(0, len(parts)), rng.choice(literals).strip())
+            s = " ".join(parts) + rng.choice(punctuation)
+        else:
+            s = rng.choice(samples) + " " + rng.choice(literals) + rng.choice(words) + rng.choice(punctuation)
+        # also feed what the input pipeline makes of it, which is what the matchers see in production
+        yield s if rng.random() < 0.5 else Eliza.prepare_statement(s)
+
+
+def shrink(statement, fails):
+    """ Smallest statement (by removing words, then characters) for which fails() still holds """
+    changed = True
+    while changed:
+        changed = False
+        for parts, sep in ((statement.split(" "), " "), (list(statement), "")):
+            for i in range(len(parts)):
+                candidate = sep.join(parts[:i] + parts[i + 1:])
+                if fails(candidate):
+                    statement = candidate
+                    changed = True
+                    break
+            if changed:
+                break
+    return statement
+
+
+def main(args):
+    count = int(args[args.index("--count") + 1]) if "--count" in args else 20000
+    seed = int(args[args.index("--seed") + 1]) if "--seed" in args else 1
+    corpus = list(utterances(count, random.Random(seed)))
+    expected = [reference_match(s) for s in corpus]
+
+    failures = 0
+    for name, matcher in matchers():
+        for statement, want in zip(corpus, expected):
+            if matcher(statement) != want:
+                def fails(s):
+                    return matcher(s) != reference_match(s)
+                small = shrink(statement, fails)
+                print("MISMATCH %s: %r -> %r, reference %r" % (name, small, matcher(small), reference_match(small)))
+                failures += 1
+                break
+
+    print("%d utterances, seed %d" % (len(corpus), seed))
+    print("%-20s %12s %10s" % ("matcher", "utterances/s", "speed-up"))
+    base = None
+    for name, matcher in [("reference", reference_match)] + matchers():
+        elapsed = timeit.timeit(lambda: [matcher(s) for s in corpus], number=1)
+        rate = len(corpus) / elapsed
+        base = base or rate
+        print("%-20s %12.0f %9.1fx" % (name, rate, rate / base))
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
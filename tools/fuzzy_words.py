@@ -0,0 +1,52 @@
+"""
+Lists the real words fuzzy matching must leave alone (see fuzzyMatching in Eliza.py).
+
+    python tools/fuzzy_words.py /usr/share/dict/words     # writes fuzzy_words.txt next to Eliza.py
+
+Every word of the word list (one per line) which fuzzy correction would change to a keyword of the
+script, e.g. farther -> father, is written to the file; Eliza loads it with the fuzzy index and never
+corrects these words. Forms of a keyword (mothers, fathered) are left out, correcting them to the
+keyword is fine. Run again after changing the script.
+"""
+
+from __future__ import print_function
+import io
+import os
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+import Eliza
+
+# endings of the forms of a keyword
+suffixes = ("s", "es", "d", "ed", "ing", "er", "ly")
+
+
+def keyword_form(word, keywords):
+    return any(word.endswith(suffix) and word[:-len(suffix)] in keywords for suffix in suffixes)
+
+
+def close_words(words):
+    """ The words which Eliza would correct to a keyword, other than forms of a keyword """
+    Eliza.fuzzyWordsFile = None
+    index = Eliza.build_fuzzy_index()
+    return set(word for word in words if len(word) >= Eliza.fuzzyMinLength and word not in index.knownWords and
+               index.nearest(word) and not keyword_form(word, index.keywordSet))
+
+
+def main(args):
+    if not args or args[0].startswith("--"):
+        print(__doc__)
+        return 2
+    with io.open(args[0], encoding="utf-8", errors="ignore") as f:
+        words = set(line.strip() for line in f if line.strip().isalpha() and line.strip().islower())
+    outputFile = os.path.join(here, "..", "fuzzy_words.txt")
+    close = sorted(close_words(words))
+    with io.open(outputFile, "w", encoding="utf-8", newline="\n") as f:
+        f.write(u"".join(word + u"\n" for word in close))
+    print("%d of %d words close to a keyword written to %s" % (len(close), len(words), os.path.normpath(outputFile)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,137 @@
+"""
+Memory footprint report of the loaded Eliza module, broken down by structure.
+Runs offline, no AWS needed:
+
+    python tools/memreport.py                 # report for the normal and the slim load
+    python tools/memreport.py --budget 1536   # also fail (exit 1) if the slim load exceeds 1536 KB
+
+The total import cost is measured with tracemalloc in a fresh interpreter (Python 3 only),
+the breakdown by walking the module's structures.
+"""
+
+from __future__ import print_function
+import os
+import subprocess
+import sys
+
+here = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(here, ".."))
+
+# default budget (KB) for the slim load
+defaultBudget = 1536
+
+importCost = """
+import sys, tracemalloc
+sys.path.insert(0, %r)
+tracemalloc.start()
+import Eliza
+snapshot = tracemalloc.take_snapshot()
+own = sum(s.size for s in snapshot.statistics("filename") if s.traceback[0].filename == Eliza.__file__)
+print(own, tracemalloc.get_traced_memory()[0])
+"""
+
+
+def deep_size(obj, seen):
+    """ Size of obj and everything it references, each object counted once """
+    if id(obj) in seen:
+        return 0
+    seen.add(id(obj))
+    size = sys.getsizeof(obj)
+    if isinstance(obj, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+    elif isinstance(obj, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in obj)
+    elif hasattr(obj, "__slots__"):
+        size += sum(deep_size(getattr(obj, name), seen) for name in obj.__slots__ if hasattr(obj, name))
+    elif hasattr(obj, "__dict__") and not isinstance(obj, type):
+        size += deep_size(obj.__dict__, seen)
+    return size
+
+
+def breakdown(Eliza):
+    """ (name, bytes) per structure; strings are counted with the structure listed first """
+    seen = set()
+    strings = [line for rule in Eliza.ruleTable for line in rule.responses] + \
+        list(Eliza.goodbyeLines) + list(Eliza.repromptLines)
+    parts = [
+        ("response strings", sum(deep_size(line, seen) for line in strings)),
+        ("compiled regexes", sum(deep_size(rule.regex, seen) for rule in Eliza.ruleTable)),
+        ("rule table", deep_size(Eliza.ruleTable, seen) + deep_size(Eliza.psychobabble, seen)),
+        ("reflections", deep_size(Eliza.reflections, seen)),
+        ("normalization tables", deep_size(Eliza.normalizeTable, seen) + deep_size(Eliza.normalizeWords, seen) +
+         deep_size(Eliza.normalizeRegex, seen)),
+        ("input caches", deep_size(Eliza.normalizeCache, seen) + deep_size(Eliza.fuzzyCache, seen)),
+        ("fuzzy index", deep_size(Eliza.fuzzyIndex, seen)),
+        ("retrieval index", deep_size(Eliza.retrievalIndex, seen) + deep_size(Eliza.constantLines, seen)),
+        ("web machinery", deep_size(Eliza.webLatency, seen) + deep_size(Eliza.webBreaker, seen)),
+        ("locale scripts", deep_size(Eliza.localeScripts, seen)),
+        ("module docstring", deep_size(Eliza.__doc__, seen)),
+    ]
+    return parts
+
+
+def locale_sizes(Eliza):
+    """ (locale file, bytes once loaded, estimate used for localeMemoryBudget) of each locale script;
+    regexes shared with the built-in script are not counted """
+    seen = set()
+    deep_size(Eliza.ruleTable, seen)
+    sizes = []
+    for name in sorted(os.listdir(Eliza.localeDir)) if os.path.isdir(Eliza.localeDir) else []:
+        if name.endswith(".json"):
+            script = Eliza.load_locale_script(name[:-len(".json")])
+            sizes.append((name, deep_size(script, seen), script.size))
+    return sizes
+
+
+def import_cost(slim):
+    """ Bytes (allocated by Eliza.py itself, allocated in total) when importing Eliza in a fresh interpreter,
+    None where tracemalloc is missing """
+    env = dict(os.environ)
+    env["ELIZA_SLIM"] = "1" if slim else ""
+    try:
+        out = subprocess.check_output([sys.executable, "-c", importCost % os.path.join(here, "..")], env=env,
+                                      stderr=subprocess.STDOUT)
+        own, total = out.decode().strip().splitlines()[-1].split()
+        return int(own), int(total)
+    except (subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def load(slim):
+    os.environ["ELIZA_SLIM"] = "1" if slim else ""
+    sys.modules.pop("Eliza", None)
+    import Eliza
+    return Eliza
+
+
+def main(args):
+    budget = defaultBudget
+    if "--budget" in args:
+        budget = int(args[args.index("--budget") + 1])
+
+    totals = {}
+    for slim in (False, True):
+        Eliza = load(slim)
+        print("--- %s load" % ("slim" if slim else "normal"))
+        for name, size in breakdown(Eliza):
+            print("%-24s %8.1f KB" % (name, size / 1024.0))
+        cost = import_cost(slim)
+        if cost is None:
+            print("%-24s %8s" % ("module allocations", "n/a (needs tracemalloc)"))
+        else:
+            print("%-24s %8.1f KB" % ("module allocations", cost[0] / 1024.0))
+            print("%-24s %8.1f KB" % ("total incl. stdlib", cost[1] / 1024.0))
+        totals[slim] = cost
+    for name, size, estimate in locale_sizes(Eliza):
+        print("locale %-17s %8.1f KB when loaded (estimate %.1f KB, budget %d KB)" %
+              (name, size / 1024.0, estimate / 1024.0, Eliza.localeMemoryBudget // 1024))
+
+    if totals[True] is not None:
+        ok = totals[True][1] <= budget * 1024
+        print("slim load %.1f KB, budget %d KB: %s" % (totals[True][1] / 1024.0, budget, "OK" if ok else "OVER BUDGET"))
+        return 0 if ok else 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
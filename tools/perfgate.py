@@ -0,0 +1,326 @@
+"""
+Performance regression gate for the local Eliza engine.
+Runs offline, no AWS needed:
+
+    python tools/perfgate.py                  # compare with the baseline, exit 1 on a regression
+    python tools/perfgate.py --update         # record the baseline for this machine and interpreter
+    python tools/perfgate.py --threshold 40   # allowed regression in percent (default 30)
+    python tools/perfgate.py --against HEAD   # compare with a git revision, measured alternately with this tree
+
+Every stage (analyze without the statement caches, reflect, response building, whole lambda_handler
+turns) runs over a fixed corpus with a fixed random seed and the Eliza settings below, in a fresh
+process with fixed string hashes. Throughput and p99 latency are the best of the rounds run in about
+a second; stages which look slower are measured once more before failing. Baselines are kept per
+machine and interpreter in tools/perf_baseline.json; on a machine without a baseline the results are
+only printed. A stored baseline can't tell a change from a slower hour of a shared machine, hence the
+wide default threshold; --against checks out the revision into a temporary directory and measures
+both trees alternately, the best results of these runs are compared (default threshold 10).
+"""
+
+from __future__ import print_function
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+here = os.path.dirname(os.path.abspath(__file__))
+# --tree DIR measures the Eliza.py in DIR (used by --against)
+tree = sys.argv[sys.argv.index("--tree") + 1] if "--tree" in sys.argv else os.path.join(here, "..")
+sys.path.insert(0, here)
+sys.path.insert(0, tree)
+import Eliza
+import bench
+
+baselineFile = os.path.join(here, "perf_baseline.json")
+baselineVersion = 1
+# the ops/s of lambda_handler and analyze move by up to 25% between runs on a shared VM
+defaultThreshold = 30.0
+# runs alternating between two trees see the same machine, their bests agree within a few percent
+againstThreshold = 10.0
+againstRuns = 6
+# the files of a tree Eliza.py loads
+treeFiles = ["Eliza.py", "eliza_rules.py", "fuzzy_words.txt", "locales/de.json"]
+# p99 changes smaller than this (us) are below the timer resolution and scheduling noise
+minP99Change = 5.0
+seed = 1
+# each stage runs rounds of passes over the corpus for at least stageSeconds (and minRounds rounds);
+# the best round counts, which filters out most of the noise of a busy machine
+stageSeconds = 1.0
+minRounds = 5
+passes = 2
+# the Eliza settings the stages run with, so a changed default in Eliza.py doesn't move the numbers
+settings = {
+    "elizaType": "local",
+    "sessionCodec": False,
+    "topicContext": True,
+    "retrievalFallback": True,
+    "fuzzyMatching": False,
+    "admissionControl": False,
+    "profiling": False,
+    "transcriptWriter": None,
+}
+
+
+def corpus():
+    """ The sample utterances and the benchmark phrases, plus longer statements joined from them """
+    phrases = bench.sample_phrases() + bench.asrVariants + bench.asrErrors + bench.catchAllPhrases
+    rng = random.Random(seed)
+    return phrases + [rng.choice(phrases) + " and " + rng.choice(phrases) for i in range(len(phrases))]
+
+
+def machine():
+    """ Key of the baselines comparable with this run """
+    return "%s %s, %s %s on %s, %s, %d cpus" % (
+        platform.python_implementation(), platform.python_version(), platform.system(), platform.machine(),
+        platform.node() or "unknown host", cpu_model(), cpu_count())
+
+
+def cpu_model():
+    # platform.processor() is empty on Linux, the model is in /proc/cpuinfo there
+    try:
+        with open("/proc/cpuinfo") as f:
+            for line in f:
+                if line.startswith("model name"):
+                    return " ".join(line.split(":", 1)[1].split())
+    except (IOError, OSError):
+        pass
+    return platform.processor() or "unknown cpu"
+
+
+def cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 0
+
+
+def stages(phrases):
+    """ (name, function of one phrase) per stage; each gets fresh session state per round """
+    for name, value in settings.items():
+        setattr(Eliza, name, value)
+    attributes = {}
+
+    def reset():
+        attributes.clear()
+        Eliza.initialise_attributes(attributes)
+
+    def analyze(phrase):
+        # as for a statement seen the first time, so the cost of the rules shows
+        Eliza.phraseCache.clear()
+        Eliza.normalizeCache.clear()
+        Eliza.analyze(phrase, attributes)
+
+    def reflect(phrase):
+        Eliza.reflect(phrase)
+
+    responses = {}
+
+    def response(phrase):
+        message, ref = responses[phrase]
+        Eliza.encode_response(Eliza.say_message("Conversation", message, attributes,
+                                                "You: " + phrase + "\nEliza: " + message, ref))
+
+    def handler(phrase):
+        Eliza.lambda_handler(bench.turn_event(phrase, packed[0]), None)
+
+    reset()
+    for phrase in phrases:
+        responses[phrase] = Eliza.analyze_ref(phrase, attributes)
+    packed = [Eliza.encode_session_attributes(bench.session_after(5))]
+    return reset, [("analyze", analyze), ("reflect", reflect), ("response build", response),
+                   ("lambda_handler", handler)]
+
+
+def run_stage(fn, phrases, reset):
+    """ (calls per second, p99 latency in us), best of the rounds """
+    best = None
+    rounds = 0
+    until = timeit.default_timer() + stageSeconds
+    while rounds < minRounds or timeit.default_timer() < until:
+        rounds += 1
+        reset()
+        random.seed(seed)
+        times = []
+        gc.disable()
+        try:
+            for phrase in phrases * passes:
+                started = timeit.default_timer()
+                fn(phrase)
+                times.append(timeit.default_timer() - started)
+        finally:
+            gc.enable()
+        times.sort()
+        result = (len(times) / sum(times), times[min(len(times) - 1, int(len(times) * 0.99))] * 1e6)
+        best = result if best is None else (max(best[0], result[0]), min(best[1], result[1]))
+    return best
+
+
+def measure(only=None):
+    """ Stage names and {stage: {"ops": calls per second, "p99_us": p99 latency}}, for the stages in only (default all) """
+    phrases = corpus()
+    reset, stageList = stages(phrases)
+    results = {}
+    for name, fn in stageList:
+        if only is None or name in only:
+            # warm the caches and the compiled tables first
+            fn(phrases[0])
+            ops, p99 = run_stage(fn, phrases, reset)
+            results[name] = {"ops": round(ops, 1), "p99_us": round(p99, 2)}
+    return [name for name, fn in stageList], results
+
+
+def load_baselines():
+    if not os.path.exists(baselineFile):
+        return {"version": baselineVersion, "baselines": {}}
+    with open(baselineFile) as f:
+        data = json.load(f)
+    if data.get("version") != baselineVersion:
+        raise ValueError("%s has version %s, expected %d" % (baselineFile, data.get("version"), baselineVersion))
+    return data
+
+
+def change(now, base):
+    return (now - base) * 100.0 / base if base else 0.0
+
+
+def regressed(now, base, threshold):
+    return change(now["ops"], base["ops"]) < -threshold or \
+        (change(now["p99_us"], base["p99_us"]) > threshold and now["p99_us"] - base["p99_us"] >= minP99Change)
+
+
+def compare(names, results, baseline, threshold):
+    """ Print the comparison table, return the number of regressed stages """
+    print("%-16s %12s %12s %8s %10s %10s %8s" % ("stage", "base ops/s", "ops/s", "change", "base p99", "p99", "change"))
+    regressions = 0
+    for name in names:
+        now = results[name]
+        base = baseline.get(name)
+        if base is None:
+            print("%-16s %12s %12.0f %8s %10s %9.1fu %8s" % (name, "-", now["ops"], "", "-", now["p99_us"], "new"))
+            continue
+        opsChange = change(now["ops"], base["ops"])
+        p99Change = change(now["p99_us"], base["p99_us"])
+        worse = regressed(now, base, threshold)
+        regressions += worse
+        print("%-16s %12.0f %12.0f %+7.1f%% %9.1fu %9.1fu %+7.1f%%%s" % (
+            name, base["ops"], now["ops"], opsChange, base["p99_us"], now["p99_us"], p99Change,
+            "  REGRESSED" if worse else ""))
+    return regressions
+
+
+def best(runs, names):
+    """ Per stage the best throughput and p99 of the runs, for the stages measured in all of them """
+    return dict((name, {"ops": max(run[name]["ops"] for run in runs),
+                        "p99_us": min(run[name]["p99_us"] for run in runs)})
+                for name in names if all(name in run for run in runs))
+
+
+def checkout(revision):
+    """ A temporary directory with the tree files of a git revision """
+    root = os.path.normpath(os.path.join(here, ".."))
+    directory = tempfile.mkdtemp(prefix="perfgate-")
+    with open(os.devnull, "w") as devnull:
+        for name in treeFiles:
+            try:
+                data = subprocess.check_output(["git", "show", "%s:%s" % (revision, name)], cwd=root,
+                                               stderr=devnull)
+            except subprocess.CalledProcessError:
+                if name == "Eliza.py":
+                    shutil.rmtree(directory)
+                    raise ValueError("no Eliza.py in revision %s" % revision)
+                continue
+            path = os.path.join(directory, name)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(path, "wb") as f:
+                f.write(data)
+    return directory
+
+
+def measure_tree(directory):
+    """ measure() of the Eliza.py in directory, in a fresh process """
+    # the same string hashes in every run: with random ones the set and dict layouts alone move analyze by 30%
+    env = dict(os.environ, PYTHONHASHSEED="0")
+    output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--json", "--tree", directory],
+                                     env=env)
+    data = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+    return data["names"], data["results"]
+
+
+def against(revision, threshold):
+    """ Compare this tree with a git revision measured alternately, return the number of regressed stages """
+    directory = checkout(revision)
+    runs = {"base": [], "now": []}
+    try:
+        for i in range(againstRuns):
+            # alternate which tree goes first, so a trend of the machine hits both alike
+            order = [("base", directory), ("now", tree)] if i % 2 == 0 else [("now", tree), ("base", directory)]
+            for side, path in order:
+                stageNames, results = measure_tree(path)
+                runs[side].append(results)
+                if side == "now":
+                    names = stageNames
+    finally:
+        shutil.rmtree(directory)
+    print("%d utterances, seed %d, best of %d alternate runs against %s" % (len(corpus()), seed, againstRuns, revision))
+    return compare(names, best(runs["now"], names), best(runs["base"], names), threshold)
+
+
+def main(args):
+    if "--json" in args:
+        names, results = measure()
+        print(json.dumps({"names": names, "results": results}))
+        return 0
+    if "--against" in args:
+        threshold = float(args[args.index("--threshold") + 1]) if "--threshold" in args else againstThreshold
+        regressions = against(args[args.index("--against") + 1], threshold)
+        print("%d stage(s) regressed by more than %.0f%%" % (regressions, threshold) if regressions else
+              "no regressions beyond %.0f%%" % threshold)
+        return 1 if regressions else 0
+
+    threshold = float(args[args.index("--threshold") + 1]) if "--threshold" in args else defaultThreshold
+    key = machine()
+    names, results = measure_tree(tree)
+    data = load_baselines()
+    print("%d utterances, seed %d, %s" % (len(corpus()), seed, key))
+
+    if "--update" in args:
+        # the baseline is the median of three measurements, so one lucky or unlucky run doesn't set the bar
+        runs = [results, measure_tree(tree)[1], measure_tree(tree)[1]]
+        results = dict((name, dict((k, sorted(run[name][k] for run in runs)[1]) for k in results[name]))
+                       for name in names)
+        data["baselines"][key] = results
+        with open(baselineFile, "w") as f:
+            json.dump(data, f, indent=2, sort_keys=True, separators=(",", ": "))
+            f.write("\n")
+        compare(names, results, {}, threshold)
+        print("baseline written to %s" % baselineFile)
+        return 0
+
+    baseline = data["baselines"].get(key)
+    if baseline is None:
+        compare(names, results, {}, threshold)
+        print("no baseline for this machine - record one with --update")
+        return 0
+    # measure the stages which look slower once more, a busy moment of the machine is no regression
+    suspects = [name for name in names if name in baseline and regressed(results[name], baseline[name], threshold)]
+    if suspects:
+        retry = measure_tree(tree)[1]
+        for name in suspects:
+            results[name] = dict((k, max(results[name][k], retry[name][k]) if k == "ops" else
+                                  min(results[name][k], retry[name][k])) for k in results[name])
+    regressions = compare(names, results, baseline, threshold)
+    print("%d stage(s) regressed by more than %.0f%%" % (regressions, threshold) if regressions else
+          "no regressions beyond %.0f%%" % threshold)
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
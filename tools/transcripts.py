@@ -0,0 +1,100 @@
+"""
+Reads transcript logs written by the skill (see transcriptFile in Eliza.py).
+Runs offline, no AWS needed:
+
+    python tools/transcripts.py eliza.transcript             # summary: sessions, latency, rules hit
+    python tools/transcripts.py eliza.transcript --dump      # also print every record
+    python tools/transcripts.py eliza.transcript --replay    # replay the inputs through the local engine
+
+Replay runs every session's inputs in order through analyze_ref(), with the script of the locale
+they were logged with and a fixed random seed, and reports the engine latency and the turns which
+now match a different rule than they did when they were logged. Matched rules are compared, not the
+rules which answered (retrieval and topic follow-ups may answer instead); files written before
+transcript version 3 only logged the answering rule.
+"""
+
+from __future__ import print_function
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import Eliza
+
+
+def percentile(values, p):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+def rule_name(rule, locale=""):
+    """ Pattern of the rule in the script of the locale """
+    script = Eliza.locale_script(locale)
+    rules = Eliza.psychobabble if script is None else script.psychobabble
+    if rule < 0:
+        return "(none)"
+    if rule < len(rules):
+        return rules[rule][0]
+    return "(rule %d)" % rule
+
+
+def summary(records):
+    sessions = set(r[0] for r in records)
+    latencies = [r[5] for r in records]
+    print("%d turns, %d sessions, %.1f turns per session" %
+          (len(records), len(sessions), len(records) / float(max(len(sessions), 1))))
+    if records:
+        print("%.0f s span, latency p50 %d us, p99 %d us, max %d us" %
+              (records[-1][2] - records[0][2], percentile(latencies, 50), percentile(latencies, 99), max(latencies)))
+    hits = {}
+    for r in records:
+        hits[r[7], r[3]] = hits.get((r[7], r[3]), 0) + 1
+    answeredElsewhere = sum(1 for r in records if r[8] != r[3])
+    print("%d turns answered by another rule than the matched one (retrieval, topics)" % answeredElsewhere)
+    print("%-6s %6s %6s  %s" % ("locale", "rule", "turns", "pattern"))
+    for (locale, rule), count in sorted(hits.items(), key=lambda item: -item[1])[:20]:
+        print("%-6s %6d %6d  %s" % (locale or "-", rule, count, rule_name(rule, locale)))
+
+
+def replay(records):
+    attributesBySession = {}
+    latencies = []
+    changed = 0
+    # line choice, retrieval and topic follow-ups draw random numbers
+    random.seed(1)
+    for sessionId, turn, timestamp, rule, line, latency, text, locale, answered in records:
+        attributes = attributesBySession.get(sessionId)
+        if attributes is None:
+            attributes = attributesBySession[sessionId] = {}
+            Eliza.initialise_attributes(attributes)
+        script = Eliza.locale_script(locale)
+        started = timeit.default_timer()
+        Eliza.analyze_ref(text, attributes, script)
+        latencies.append(int((timeit.default_timer() - started) * 1e6))
+        now = Eliza.matched_rule(text, script)
+        if rule >= 0 and now != rule:
+            changed += 1
+            print("turn %s/%d %r: %s -> %s" % (sessionId, turn, text, rule_name(rule, locale), rule_name(now, locale)))
+    print("replayed %d turns, engine latency p50 %d us, p99 %d us, %d turns match a different rule" %
+          (len(records), percentile(latencies, 50), percentile(latencies, 99), changed))
+
+
+def main(args):
+    if not args or args[0].startswith("--"):
+        print(__doc__)
+        return 2
+    records = list(Eliza.read_transcript(args[0]))
+    if "--dump" in args:
+        for r in records:
+            print("%s %4d %.3f %3d %2d %7d  %s  %s  %3d" % r)
+    summary(records)
+    if "--replay" in args:
+        replay(records)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))